@@ -20,6 +20,7 @@ def main():
     # Settings
     sdk_version = 30
     mode = Downloader.MODE_GPAPI
+    num_workers = cfg.NUM_WORKERS
 
     # Set output path
     out_dir = os.path.join(os.path.abspath(cfg.OUT))
@@ -37,7 +38,8 @@ def main():
             pkg_list.append((splitted[0], splitted[1]))
 
     # Start downloading
-    d = Downloader(mode, sdk_version=None, sdk_version_match=False)
+    d = Downloader(mode, sdk_version=None, sdk_version_match=False,
+                   num_workers=num_workers)
     d.download_all(pkg_list[0:3], out_dir)
 
     logger.info("Completed.")
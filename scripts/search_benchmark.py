@@ -0,0 +1,156 @@
+#!/usr/bin/env python3.7
+'''
+@author: Chang Min Park (cpark22@buffalo.edu)
+
+Compare version search strategies on synthetic version catalogs. Reports
+the average number of probes (version codes requested from Google Play) per
+app and SDK version, separately for searches that found a version and those
+that ended without one, the share of available versions found, and the
+number of rounds of concurrent probes, i.e., the latency of a search.
+'''
+
+import argparse
+import random
+import sys
+
+sys.path.append('..')
+
+import src.version_search as vs
+
+# How version codes grow between releases
+# - sequential: 1, 2, 3, ... with a few gaps
+# - sparse: random gaps of up to 1000
+# - dated: codes like 2019061201 (date and build number)
+# - suffix: codes like 300012303 (flavor digit, version and ABI suffix)
+SCHEMES = ['sequential', 'sparse', 'dated', 'suffix']
+
+
+def make_catalog(scheme: str, rng: random.Random) -> dict:
+    '''
+    Version code -> (minSdkVersion, targetSdkVersion, available) of an app.
+    targetSdkVersion never decreases, and old versions are less likely to
+    be available.
+    '''
+    num_releases = rng.randint(10, 300)
+    tgt_sdk = rng.randint(8, 24)
+    min_sdk = rng.randint(1, tgt_sdk)
+    vc = {'dated': 2012010100, 'suffix': 300010003}.get(scheme,
+                                                       rng.randint(1, 5))
+    catalog = {}
+    for idx in range(num_releases):
+        if rng.random() < 8 / num_releases:
+            tgt_sdk = min(30, tgt_sdk + rng.randint(1, 3))
+        if rng.random() < 2 / num_releases:
+            min_sdk = min(tgt_sdk, min_sdk + rng.randint(1, 4))
+        recent = idx >= num_releases - 5
+        catalog[vc] = (min_sdk, tgt_sdk, recent or rng.random() < 0.7)
+        if scheme == 'sequential':
+            vc += 1 if rng.random() < 0.9 else rng.randint(2, 10)
+        elif scheme == 'sparse':
+            vc += rng.randint(1, 1000)
+        elif scheme == 'dated':
+            vc += rng.choice([1, 1, 100, 10000])
+        else:
+            vc += 100 * rng.randint(1, 3)
+    return catalog
+
+
+def is_accepted(min_sdk: int, tgt_sdk: int, sdk_version: int,
+                match: bool) -> bool:
+    if match:
+        return tgt_sdk == sdk_version
+    return min_sdk <= sdk_version <= tgt_sdk
+
+
+def run(strategy_name: str, catalog: dict, sdk_version: int, match: bool,
+        k: int, rng: random.Random,
+        version_lattice: vs.VersionLattice) -> tuple:
+    '''
+    Search the catalog as Downloader does, with probes of a round applied in
+    version-code order. Returns (number of probes, number of rounds, found)
+    '''
+    latest_vc = max(catalog)
+    strategy = vs.STRATEGIES[strategy_name](sdk_version, latest_vc, None, {},
+                                            version_lattice)
+    probed = set()
+    num_rounds = 0
+    while True:
+        vcs = strategy.next_vcs(k)
+        if not vcs:
+            return len(probed), num_rounds, False
+        # Probes already made (e.g., by Bisect) are looked up, not requested
+        num_rounds += any([vc not in probed for vc in vcs])
+        probed.update(vcs)
+        for vc in sorted(vcs):
+            if not strategy.contains(vc):
+                continue
+            min_sdk, tgt_sdk, available = catalog.get(vc, (-1, -1, False))
+            if not available:
+                strategy.update(vc, None)
+                continue
+            if version_lattice:
+                version_lattice.add(vc)
+            if is_accepted(min_sdk, tgt_sdk, sdk_version, match):
+                return len(probed), num_rounds, True
+            strategy.update(vc, tgt_sdk)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--apps', type=int, default=300)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--match', action='store_true',
+                            help='targetSdkVersion must equal SDK version')
+    arg_parser.add_argument('--parallel', type=int, default=3,
+                            help='probes at once (NUM_PARALLEL_PROBES)')
+    arg_parser.add_argument('--lattice', action='store_true',
+                            help='learn valid version codes')
+    arg_parser.add_argument('--known', type=int, default=0,
+                            help='versions known to exist beforehand, as '
+                                 'if in SDK_CACHE (with --lattice)')
+    args = arg_parser.parse_args()
+
+    print('%-12s %-12s %8s %8s %8s %8s %8s' %
+          ('scheme', 'strategy', 'probes', 'found', 'missing', 'found%',
+           'rounds'))
+    for scheme in SCHEMES:
+        rng = random.Random(args.seed)
+        catalogs = [make_catalog(scheme, rng) for _ in range(args.apps)]
+        for name in vs.STRATEGIES:
+            # Probes of searches that found a version and that didn't
+            probes = {True: [], False: []}
+            num_exists, num_rounds = 0, 0
+            for catalog in catalogs:
+                # Like Downloader, the pattern of valid version codes of an
+                # app is learned across its SDK versions
+                version_lattice = vs.VersionLattice() if args.lattice \
+                    else None
+                if version_lattice:
+                    version_lattice.add(max(catalog))
+                    available = [vc for vc, (_, _, a) in catalog.items() if a]
+                    for vc in rng.sample(available,
+                                         min(args.known, len(available))):
+                        version_lattice.add(vc)
+                sdks = sorted(set([t for _, t, _ in catalog.values()]))
+                for sdk_version in range(sdks[0], sdks[-1] + 1):
+                    num_probes, rounds, found = run(name, catalog,
+                                                    sdk_version, args.match,
+                                                    args.parallel, rng,
+                                                    version_lattice)
+                    probes[found].append(num_probes)
+                    num_rounds += rounds
+                    num_exists += any([
+                        available and is_accepted(min_sdk, tgt_sdk,
+                                                  sdk_version, args.match)
+                        for min_sdk, tgt_sdk, available in catalog.values()])
+            all_probes = probes[True] + probes[False]
+            print('%-12s %-12s %8.2f %8.2f %8.2f %7.1f%% %8.2f' %
+                  (scheme, name, sum(all_probes) / len(all_probes),
+                   sum(probes[True]) / max(1, len(probes[True])),
+                   sum(probes[False]) / max(1, len(probes[False])),
+                   100 * len(probes[True]) / max(1, num_exists),
+                   num_rounds / len(all_probes)))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,37 +3,162 @@
 @author: Chang Min Park (cpark22@buffalo.edu)
 '''
 
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
 from re import findall
 from subprocess import Popen
 
 # Local package
 import src.config as conf
 import src.common as common
+import src.axml as axml
 
 encoding = "utf-8"
 
+# Key: (path, size, mtime), Value: result of get_manifest() or inspect()
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_manifest(apk) -> dict:
+    '''
+    Read package name, versionCode and SDK versions of the given APK in one
+    pass. Missing integer fields are -1. 'apk' can be a path or a seekable
+    file-like object, which is written to a temporary file only for aapt.
+    Results for paths are cached until the file changes.
+    '''
+    if isinstance(apk, str):
+        key = _get_key(apk)
+        manifest = _cache_get(key, 'manifest') or _cache_get(key, 'badging')
+        if manifest:
+            return manifest
+    if conf.USE_AXML_PARSER:
+        try:
+            manifest = axml.read_manifest(apk)
+            if isinstance(apk, str):
+                _cache_put(key, 'manifest', manifest)
+            return manifest
+        except axml.AxmlError:
+            pass
+    if isinstance(apk, str):
+        return inspect(apk)
+    with tempfile.NamedTemporaryFile(suffix='.apk') as f:
+        apk.seek(0)
+        shutil.copyfileobj(apk, f)
+        f.flush()
+        return _dump_badging(f.name)
+
+
+def inspect(apk_path: str) -> dict:
+    '''
+    Every field of 'aapt dump badging' of the given APK from a single run:
+    the fields of get_manifest(), and
+    - nativeCode: ABIs of native libraries (native-code and alt-native-code)
+    - features: required features (uses-feature)
+    - optionalFeatures: features not required (uses-feature-not-required)
+    - impliedFeatures: features implied by permissions (uses-implied-feature)
+    Results are cached until the file changes.
+    '''
+    key = _get_key(apk_path)
+    badging = _cache_get(key, 'badging')
+    if badging is None:
+        badging = _dump_badging(apk_path)
+        if badging['package'] is not None:
+            _cache_put(key, 'badging', badging)
+    return badging
+
 
 def get_package_name(apk_path: str) -> str:
-    command = [conf.AAPT_PATH, 'dump', 'badging', apk_path]
-    output = common.run_command(command).decode(encoding)
-    return findall("(?<=package: name=')[^']*", output)[0]
+    return get_manifest(apk_path)['package']
 
 
 def get_tgt_sdk_version(apk_path: str) -> int:
-    command = [conf.AAPT_PATH, 'dump', 'badging', apk_path]
-    output = common.run_command(command).decode(encoding)
-    v = findall("(?<=targetSdkVersion:')[^']*", output)
-    if v == None or len(v) == 0:
-        return -1
-    else:
-        return int(v[0])
+    return get_manifest(apk_path)['targetSdkVersion']
 
 
 def get_min_sdk_version(apk_path: str) -> int:
+    return get_manifest(apk_path)['minSdkVersion']
+
+
+# ----------------- #
+#   Local Methods   #
+# ----------------- #
+def _dump_badging(apk_path: str) -> dict:
+    '''
+    Run 'aapt dump badging' once and parse its lines, e.g.,
+      package: name='com.example' versionCode='12' versionName='1.2'
+      sdkVersion:'16'
+      native-code: 'arm64-v8a' 'armeabi-v7a'
+    '''
     command = [conf.AAPT_PATH, 'dump', 'badging', apk_path]
-    output = common.run_command(command).decode(encoding)
-    v = findall("(?<=sdkVersion:')[^']*", output)
-    if v == None or len(v) == 0:
-        return -1
-    else:
-        return int(v[0])
+    output = common.run_command(command).decode(encoding, errors='replace')
+
+    def to_int(v: str) -> int:
+        return int(v) if v and v.isdigit() else -1
+
+    result = {
+        'package': None,
+        'versionCode': -1,
+        'versionName': None,
+        'minSdkVersion': -1,
+        'targetSdkVersion': -1,
+        'maxSdkVersion': -1,
+        'nativeCode': [],
+        'features': [],
+        'optionalFeatures': [],
+        'impliedFeatures': [],
+    }
+    for line in output.splitlines():
+        name, _, value = line.partition(':')
+        attrs = dict(findall(r"([\w-]+)='([^']*)'", value))
+        values = findall(r"'([^']*)'", value)
+        if name == 'package':
+            result['package'] = attrs.get('name')
+            result['versionCode'] = to_int(attrs.get('versionCode'))
+            result['versionName'] = attrs.get('versionName')
+        elif name == 'sdkVersion' and values:
+            result['minSdkVersion'] = to_int(values[0])
+        elif name in ['targetSdkVersion', 'maxSdkVersion'] and values:
+            result[name] = to_int(values[0])
+        elif name in ['native-code', 'alt-native-code']:
+            result['nativeCode'] += [abi for abi in values
+                                     if abi not in result['nativeCode']]
+        elif name == 'uses-feature' and 'name' in attrs:
+            key = 'optionalFeatures' if attrs.get('required') == 'false' \
+                else 'features'
+            result[key].append(attrs['name'])
+        elif name == 'uses-feature-not-required' and 'name' in attrs:
+            result['optionalFeatures'].append(attrs['name'])
+        elif name == 'uses-implied-feature' and 'name' in attrs:
+            result['impliedFeatures'].append(attrs['name'])
+    return result
+
+
+def _get_key(apk_path: str) -> tuple:
+    try:
+        stat = os.stat(apk_path)
+    except OSError:
+        return None
+    return (os.path.abspath(apk_path), stat.st_size, stat.st_mtime_ns)
+
+
+def _cache_get(key: tuple, kind: str) -> dict:
+    if key is None:
+        return None
+    with _cache_lock:
+        result = _cache.get(key + (kind, ))
+        if result is not None:
+            _cache.move_to_end(key + (kind, ))
+        return result
+
+
+def _cache_put(key: tuple, kind: str, result: dict) -> None:
+    if key is None:
+        return
+    with _cache_lock:
+        _cache[key + (kind, )] = result
+        while len(_cache) > conf.INSPECT_CACHE_SIZE:
+            _cache.popitem(last=False)
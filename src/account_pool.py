@@ -0,0 +1,131 @@
+#!/usr/bin/env python3.7
+'''
+@author: Chang Min Park (cpark22@buffalo.edu)
+'''
+
+import threading
+import time
+
+# Local package
+from src.gpapi.googleplay import GooglePlayAPI
+from src.logger import Logger
+from src.rate_limiter import RateLimiter
+from src.config import GpapiSettings as GS
+import src.config as cfg
+
+
+class Account:
+    '''
+    A Google account with its own GooglePlayAPI instance and rate limiter.
+    'health' is a moving average of request outcomes (1: all succeeded).
+    '''
+    def __init__(self, email: str, password: str,
+                 pool_maxsize: int = 10) -> None:
+        self.email = email
+        self.password = password
+        self.rate_limiter = RateLimiter(account=email) \
+            if cfg.ENABLE_RATE_LIMIT else None
+        self.server = GooglePlayAPI(locale=GS.LOCALE, timezone=GS.TIMEZONE,
+                                    rate_limiter=self.rate_limiter,
+                                    pool_connections=cfg.POOL_CONNECTIONS,
+                                    pool_maxsize=pool_maxsize,
+                                    max_retries=cfg.MAX_RETRIES)
+        self.login_lock = threading.Lock()
+        self.health = 1.0
+        self.in_flight = 0
+        self.requests = 0
+        self.busy = 0
+        self.quarantined_until = 0
+        self.logged_in = False
+
+    def get_load(self) -> float:
+        '''
+        Expected time to serve one more request
+        '''
+        rate = self.rate_limiter.get_rate() if self.rate_limiter else 1
+        return (self.in_flight + 1) / rate
+
+
+class AccountPool:
+    '''
+    Pool of Google accounts. Each request is routed to the least-loaded
+    healthy account. An account whose health drops below 'min_health'
+    (e.g., the server keeps saying "busy") is quarantined for 'quarantine'
+    seconds, and comes back with a half health.
+    '''
+    def __init__(self,
+                 accounts: list,
+                 min_health: float = GS.ACCOUNT_MIN_HEALTH,
+                 quarantine: float = GS.ACCOUNT_QUARANTINE) -> None:
+        self.accounts = accounts
+        self._min_health = min_health
+        self._quarantine = quarantine
+        self._lock = threading.Lock()
+        self._logger = Logger.get_instance()
+
+    def __len__(self) -> int:
+        return len(self.accounts)
+
+    def acquire(self, exclude: list = None) -> Account:
+        '''
+        Take the least-loaded account that is logged in and not
+        quarantined, waiting for a quarantine to end if needed. Accounts in
+        'exclude' are used only if no other account is available.
+        '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                ready = [a for a in self.accounts
+                         if a.logged_in and a.quarantined_until <= now]
+                if not [a for a in self.accounts if a.logged_in]:
+                    raise RuntimeError("No Google account is logged in")
+                preferred = [a for a in ready if a not in (exclude or [])]
+                if preferred or ready:
+                    account = min(preferred or ready,
+                                  key=lambda a: (a.get_load(), a.requests))
+                    account.in_flight += 1
+                    account.requests += 1
+                    return account
+                wait = min([a.quarantined_until for a in self.accounts
+                            if a.logged_in]) - now
+            time.sleep(max(wait, 0.1))
+
+    def release(self, account: Account, busy: bool = False,
+                failed: bool = False) -> None:
+        '''
+        Return the account with the outcome of its request
+        - 'busy': the server refused to serve the account
+        - 'failed': the request failed, e.g., with a connection error
+        '''
+        with self._lock:
+            account.in_flight -= 1
+            if busy:
+                account.busy += 1
+                account.health *= 0.5
+            elif failed:
+                account.health *= 0.9
+            else:
+                account.health = account.health * 0.9 + 0.1
+            quarantine = account.health < self._min_health
+            if quarantine:
+                account.quarantined_until = \
+                    time.monotonic() + self._quarantine
+                account.health = 0.5
+        if quarantine:
+            self._logger.info(" - Quarantine %s for %ds" %
+                              (account.email, self._quarantine))
+
+    def get_stats(self) -> list:
+        '''
+        Requests, "busy" replies and health of each account
+        '''
+        with self._lock:
+            now = time.monotonic()
+            return [{
+                'email': a.email,
+                'requests': a.requests,
+                'busy': a.busy,
+                'health': a.health,
+                'quarantined': a.quarantined_until > now,
+                'logged_in': a.logged_in
+            } for a in self.accounts]
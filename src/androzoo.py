@@ -0,0 +1,137 @@
+#!/usr/bin/env python3.7
+'''
+@author: Chang Min Park (cpark22@buffalo.edu)
+'''
+
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Local package
+from src.logger import Logger
+from src.config import AzSettings as AS
+import src.config as cfg
+
+CHUNK_SIZE = 1 << 16
+
+# HTTP status codes worth retrying
+TRANSIENT_STATUS = [429, 500, 502, 503, 504]
+
+
+class AndroZooError(Exception):
+    def __init__(self, value, transient=False):
+        self.value = value
+        self.transient = transient
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class AndroZooClient:
+    '''
+    Client of AndroZoo's download API. APKs are downloaded by sha256 and
+    streamed to a temporary file while being hashed, and the file is
+    renamed to the given path only if the hash matches. Transient errors
+    (connection errors, HTTP 429/5xx and hash mismatches) are retried with
+    exponential backoff.
+    '''
+    def __init__(self,
+                 api_key: str,
+                 url: str = AS.URL,
+                 num_downloads: int = AS.NUM_DOWNLOADS,
+                 max_retries: int = cfg.MAX_RETRIES,
+                 backoff: float = AS.RETRY_BACKOFF,
+                 timeout: float = AS.TIMEOUT) -> None:
+        self._api_key = api_key
+        self._url = url
+        self._num_downloads = max(1, num_downloads)
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._timeout = timeout
+        self._logger = Logger.get_instance()
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self._num_downloads)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def download(self, sha256: str, out_path: str) -> int:
+        '''
+        Download the APK of the given sha256 to 'out_path', and return its
+        size. Raises AndroZooError if it fails after the retries.
+        '''
+        err = None
+        for attempt in range(self._max_retries + 1):
+            if attempt > 0:
+                time.sleep(self._backoff * (2 ** (attempt - 1)))
+            try:
+                return self._download(sha256, out_path)
+            except AndroZooError as e:
+                err = e
+                if not e.transient:
+                    break
+            except requests.RequestException as e:
+                err = AndroZooError(str(e), transient=True)
+            self._logger.debug(' - AndroZoo failed to download %s (%d/%d). %s'
+                               % (sha256, attempt + 1, self._max_retries + 1,
+                                  err))
+        raise err
+
+    def download_all(self, apks: list) -> dict:
+        '''
+        Download the given (sha256, out_path) pairs concurrently, and return
+        the error of each sha256 (None if downloaded)
+        '''
+        def download_inner(apk: tuple) -> str:
+            try:
+                self.download(*apk)
+                return None
+            except AndroZooError as e:
+                return str(e)
+
+        with ThreadPoolExecutor(self._num_downloads) as executor:
+            errors = executor.map(download_inner, apks)
+            return {sha256: err for (sha256, _), err in zip(apks, errors)}
+
+    def close(self) -> None:
+        self._session.close()
+
+    # ----------------- #
+    #   Local Methods   #
+    # ----------------- #
+    def _download(self, sha256: str, out_path: str) -> int:
+        start = time.monotonic()
+        params = {'apikey': self._api_key, 'sha256': sha256}
+        tmp_path = out_path + '.part'
+        with self._session.get(self._url, params=params, stream=True,
+                               timeout=self._timeout) as response:
+            if response.status_code != 200:
+                raise AndroZooError(
+                    "HTTP %d" % (response.status_code),
+                    transient=response.status_code in TRANSIENT_STATUS)
+
+            # Hash while streaming to the temporary file
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        digest.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+                if digest.hexdigest().lower() != sha256.lower():
+                    raise AndroZooError("sha256 mismatch (%d bytes)" % (size),
+                                        transient=True)
+                os.replace(tmp_path, out_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        elapsed = time.monotonic() - start
+        self._logger.debug(' - AndroZoo: %s (%d bytes, %.1fs)' %
+                           (sha256, size, elapsed))
+        return size
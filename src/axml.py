@@ -0,0 +1,217 @@
+#!/usr/bin/env python3.7
+'''
+@author: Chang Min Park (cpark22@buffalo.edu)
+
+Pure-Python reader for the binary XML (AXML) form of AndroidManifest.xml,
+so that manifest fields can be read without forking aapt.
+'''
+
+import struct
+import zipfile
+import zlib
+
+MANIFEST = "AndroidManifest.xml"
+
+# Chunk types (frameworks/base/libs/androidfw/include/androidfw/ResourceTypes.h)
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_TYPE = 0x0003
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+
+# Typed value data types
+TYPE_REFERENCE = 0x01
+TYPE_STRING = 0x03
+TYPE_INT_DEC = 0x10
+TYPE_INT_HEX = 0x11
+
+UTF8_FLAG = 0x100
+NO_INDEX = 0xFFFFFFFF
+
+# Resource IDs of android:* attributes that we care about. Attribute names
+# in the string pool may be stripped by obfuscators, the IDs are not.
+ATTR_IDS = {
+    0x0101021b: 'versionCode',
+    0x0101021c: 'versionName',
+    0x0101020c: 'minSdkVersion',
+    0x01010270: 'targetSdkVersion',
+    0x01010271: 'maxSdkVersion',
+}
+
+
+class AxmlError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def read_manifest(apk) -> dict:
+    '''
+    Read and decode AndroidManifest.xml of the given APK. 'apk' can be a
+    path or a seekable file-like object.
+    '''
+    try:
+        with zipfile.ZipFile(apk) as zf:
+            data = zf.read(MANIFEST)
+    except (zipfile.BadZipFile, KeyError, OSError, zlib.error,
+            NotImplementedError) as e:
+        raise AxmlError("Cannot read %s: %s" % (MANIFEST, e))
+    return decode_manifest(data)
+
+
+def decode_manifest(data: bytes) -> dict:
+    '''
+    Decode a binary AndroidManifest.xml in one pass and return:
+      {'package', 'versionCode', 'versionName',
+       'minSdkVersion', 'targetSdkVersion', 'maxSdkVersion'}
+    Missing integer fields are set to -1 (same as aapt_utils). Raises
+    AxmlError if the manifest is truncated or malformed.
+    '''
+    try:
+        return _decode_manifest(data)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise AxmlError("Malformed manifest: %s" % (e))
+
+
+# ----------------- #
+#   Local Methods   #
+# ----------------- #
+def _decode_manifest(data: bytes) -> dict:
+    if len(data) < 8:
+        raise AxmlError("Manifest is too short")
+    chunk_type, header_size, total_size = struct.unpack_from('<HHI', data, 0)
+    if chunk_type != RES_XML_TYPE:
+        raise AxmlError("Not a binary XML file (type: 0x%x)" % (chunk_type))
+
+    result = {
+        'package': None,
+        'versionCode': -1,
+        'versionName': None,
+        'minSdkVersion': -1,
+        'targetSdkVersion': -1,
+        'maxSdkVersion': -1,
+    }
+    strings, res_ids = [], []
+    end = min(total_size, len(data))
+    offset = header_size
+    while offset + 8 <= end:
+        chunk_type, header_size, chunk_size = \
+            struct.unpack_from('<HHI', data, offset)
+        if chunk_size < 8:
+            raise AxmlError("Invalid chunk size at offset %d" % (offset))
+
+        if chunk_type == RES_STRING_POOL_TYPE:
+            strings = _read_string_pool(data, offset)
+        elif chunk_type == RES_XML_RESOURCE_MAP_TYPE:
+            count = (chunk_size - header_size) // 4
+            res_ids = list(struct.unpack_from('<%dI' % (count), data,
+                                              offset + header_size))
+        elif chunk_type == RES_XML_START_ELEMENT_TYPE:
+            name, attrs = _read_element(data, offset, header_size, strings,
+                                        res_ids)
+            if name == 'manifest':
+                result['package'] = attrs.get('package')
+                result['versionCode'] = _to_int(attrs.get('versionCode'))
+                result['versionName'] = attrs.get('versionName')
+            elif name == 'uses-sdk':
+                for key in ['minSdkVersion', 'targetSdkVersion',
+                            'maxSdkVersion']:
+                    result[key] = _to_int(attrs.get(key))
+                # Nothing else in the manifest is needed
+                break
+        offset += chunk_size
+
+    if result['package'] is None:
+        raise AxmlError("<manifest> element is not found")
+    return result
+
+
+def _read_string_pool(data: bytes, offset: int) -> list:
+    '''
+    Read all strings in the string pool chunk at the given offset
+    '''
+    (header_size, _, string_count, _, flags, strings_start, _) = \
+        struct.unpack_from('<HIIIIII', data, offset + 2)
+    is_utf8 = flags & UTF8_FLAG
+    offsets = struct.unpack_from('<%dI' % (string_count), data,
+                                 offset + header_size)
+    base = offset + strings_start
+    strings = []
+    for str_off in offsets:
+        pos = base + str_off
+        if is_utf8:
+            # utf-16 length then utf-8 length, each 1 or 2 bytes
+            _, pos = _read_len8(data, pos)
+            length, pos = _read_len8(data, pos)
+            strings.append(data[pos:pos + length].decode('utf-8', 'replace'))
+        else:
+            length, pos = _read_len16(data, pos)
+            strings.append(data[pos:pos + length * 2]
+                           .decode('utf-16-le', 'replace'))
+    return strings
+
+
+def _read_len8(data: bytes, pos: int):
+    length = data[pos]
+    if length & 0x80:
+        return ((length & 0x7F) << 8) | data[pos + 1], pos + 2
+    return length, pos + 1
+
+
+def _read_len16(data: bytes, pos: int):
+    length = struct.unpack_from('<H', data, pos)[0]
+    if length & 0x8000:
+        low = struct.unpack_from('<H', data, pos + 2)[0]
+        return ((length & 0x7FFF) << 16) | low, pos + 4
+    return length, pos + 2
+
+
+def _read_element(data: bytes, offset: int, header_size: int, strings: list,
+                  res_ids: list):
+    '''
+    Read the name and attributes of a start-element chunk. Attributes in the
+    android namespace are keyed by resource ID when possible.
+    '''
+    ext = offset + header_size
+    _, name_idx, attr_start, attr_size, attr_count = \
+        struct.unpack_from('<IIHHH', data, ext)
+    name = _get_string(strings, name_idx)
+
+    attrs = {}
+    pos = ext + attr_start
+    for _ in range(attr_count):
+        _, attr_name_idx, raw_idx, _, _, data_type, value = \
+            struct.unpack_from('<IIIHBBI', data, pos)
+        pos += attr_size
+
+        if attr_name_idx < len(res_ids) and res_ids[attr_name_idx] in ATTR_IDS:
+            attr_name = ATTR_IDS[res_ids[attr_name_idx]]
+        else:
+            attr_name = _get_string(strings, attr_name_idx)
+
+        if data_type == TYPE_STRING:
+            attrs[attr_name] = _get_string(strings, value)
+        elif data_type in (TYPE_INT_DEC, TYPE_INT_HEX):
+            attrs[attr_name] = value
+        elif raw_idx != NO_INDEX:
+            attrs[attr_name] = _get_string(strings, raw_idx)
+        elif data_type == TYPE_REFERENCE:
+            # e.g., a value from resources.arsc which we don't resolve
+            attrs[attr_name] = None
+        else:
+            attrs[attr_name] = value
+    return name, attrs
+
+
+def _get_string(strings: list, idx: int) -> str:
+    return strings[idx] if idx < len(strings) else None
+
+
+def _to_int(value) -> int:
+    if isinstance(value, int):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3.7
+'''
+@author: Chang Min Park (cpark22@buffalo.edu)
+'''
+
+import csv
+import os
+import sqlite3
+import threading
+
+# Local package
+from src.logger import Logger
+
+# Columns of AndroZoo's latest.csv kept in the index
+PKG_NAME = 'pkg_name'
+VERCODE = 'vercode'
+DEX_DATE = 'dex_date'
+SHA256 = 'sha256'
+APK_SIZE = 'apk_size'
+MARKETS = 'markets'
+
+BATCH_SIZE = 100000
+
+
+class AzIndex:
+    '''
+    SQLite index of AndroZoo's latest.csv keyed by package name. Besides
+    the columns needed to pick a version, each row keeps the byte offset and
+    length of its line in the CSV, so that a per-package CSV for the az tool
+    can be cut out with a few seeks instead of scanning the whole file.
+    '''
+    def __init__(self, db_path: str, csv_path: str) -> None:
+        self._db_path = db_path
+        self._csv_path = csv_path
+        self._logger = Logger.get_instance()
+        self._lock = threading.Lock()
+        if not self._is_up_to_date():
+            self.build()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._header = self._get_meta(self._conn, 'header')
+
+    def build(self) -> None:
+        '''
+        One-time scan of the CSV. The index is written to a temporary file
+        and then renamed, so that an interrupted build is not used.
+        '''
+        self._logger.info("Indexing %s ..." % (self._csv_path))
+        tmp_path = self._db_path + '.tmp'
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('''
+            CREATE TABLE apks (
+                pkg_name TEXT NOT NULL,
+                vercode INTEGER,
+                dex_date TEXT,
+                sha256 TEXT NOT NULL,
+                apk_size INTEGER,
+                markets TEXT,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            )''')
+
+        num_rows = 0
+        with open(self._csv_path, 'rb') as f:
+            header = f.readline()
+            columns = next(csv.reader([header.decode('utf-8')]))
+            idx = {c: columns.index(c) for c in [PKG_NAME, VERCODE, DEX_DATE,
+                                                 SHA256, APK_SIZE, MARKETS]}
+            offset = len(header)
+            batch = []
+            for line in f:
+                row = next(csv.reader([line.decode('utf-8', 'replace')]))
+                if len(row) == len(columns):
+                    batch.append((row[idx[PKG_NAME]],
+                                  _to_int(row[idx[VERCODE]]),
+                                  row[idx[DEX_DATE]], row[idx[SHA256]],
+                                  _to_int(row[idx[APK_SIZE]]),
+                                  row[idx[MARKETS]], offset, len(line)))
+                offset += len(line)
+                if len(batch) >= BATCH_SIZE:
+                    conn.executemany(
+                        'INSERT INTO apks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        batch)
+                    num_rows += len(batch)
+                    batch = []
+            conn.executemany('INSERT INTO apks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             batch)
+            num_rows += len(batch)
+
+        conn.execute('CREATE INDEX apks_pkg_name ON apks (pkg_name)')
+        stat = os.stat(self._csv_path)
+        conn.executemany('INSERT INTO meta VALUES (?, ?)',
+                         [('header', header.decode('utf-8')),
+                          ('csv_size', str(stat.st_size)),
+                          ('csv_mtime', str(stat.st_mtime))])
+        conn.commit()
+        conn.close()
+        os.replace(tmp_path, self._db_path)
+        self._logger.info(" - %d apps have been indexed." % (num_rows))
+
+    def lookup(self, pkg_name: str, market: str = None) -> list:
+        '''
+        All versions of the given package (optionally only those in the
+        given market), ordered by version code
+        '''
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT pkg_name, vercode, dex_date, sha256, apk_size, '
+                'markets, offset, length FROM apks WHERE pkg_name = ? '
+                'ORDER BY vercode', (pkg_name, )).fetchall()
+        keys = [PKG_NAME, VERCODE, DEX_DATE, SHA256, APK_SIZE, MARKETS,
+                'offset', 'length']
+        apks = [dict(zip(keys, row)) for row in rows]
+        if market:
+            apks = [a for a in apks if market in a[MARKETS].split('|')]
+        return apks
+
+    def write_csv(self, apks: list, out_path: str) -> None:
+        '''
+        Write the original CSV lines of the given rows (from lookup()) with
+        the header, i.e., an input file for the az tool
+        '''
+        with open(self._csv_path, 'rb') as src, \
+                open(out_path, 'wb') as out:
+            out.write(self._header.encode('utf-8'))
+            for apk in apks:
+                src.seek(apk['offset'])
+                out.write(src.read(apk['length']))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # ----------------- #
+    #   Local Methods   #
+    # ----------------- #
+    def _is_up_to_date(self) -> bool:
+        '''
+        Whether the index was built from the current CSV file
+        '''
+        if not os.path.exists(self._db_path):
+            return False
+        try:
+            conn = sqlite3.connect(self._db_path)
+            size = self._get_meta(conn, 'csv_size')
+            mtime = self._get_meta(conn, 'csv_mtime')
+            conn.close()
+        except sqlite3.Error:
+            return False
+        stat = os.stat(self._csv_path)
+        return size == str(stat.st_size) and mtime == str(stat.st_mtime)
+
+    @staticmethod
+    def _get_meta(conn: sqlite3.Connection, key: str) -> str:
+        row = conn.execute('SELECT value FROM meta WHERE key = ?',
+                           (key, )).fetchone()
+        return None if row is None else row[0]
+
+
+def _to_int(value: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        return -1
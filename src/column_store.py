@@ -0,0 +1,248 @@
+#!/usr/bin/env python3.7
+'''
+@author: Chang Min Park (cpark22@buffalo.edu)
+'''
+
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+
+MAGIC = b'COLSTORE'
+VERSION = 1
+PREAMBLE_SIZE = 16  # MAGIC and the length of the JSON header
+ALIGN = 8
+FLUSH_ROWS = 1 << 16  # Rows of each column buffered in memory by write()
+
+# Column types other than array typecodes
+STRING = 's'
+CATEGORY = 'c'
+
+
+class ColumnStoreError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class ColumnStore:
+    '''
+    Read-only columnar table stored in a single file. Numeric columns are
+    arrays of their typecode (e.g., 'b', 'i', 'q', 'd'), categorical columns
+    ('c') are codes into a list of values, and string columns ('s') are
+    offsets into a UTF-8 blob. The file is memory-mapped, so opening is
+    near-instant and columns are read without copying.
+    '''
+    def __init__(self, path: str) -> None:
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ColumnStoreError("Empty file: %s" % (path))
+        self._views = []
+        try:
+            if self._mm[:len(MAGIC)] != MAGIC:
+                raise ColumnStoreError("Not a column store: %s" % (path))
+            header_len = struct.unpack_from('<Q', self._mm, len(MAGIC))[0]
+            header = json.loads(
+                self._mm[PREAMBLE_SIZE:PREAMBLE_SIZE + header_len].decode())
+            if header['version'] != VERSION:
+                raise ColumnStoreError("Unsupported version: %d"
+                                       % (header['version']))
+        except (ColumnStoreError, ValueError, KeyError, struct.error) as e:
+            self.close()
+            raise e if isinstance(e, ColumnStoreError) else \
+                ColumnStoreError("Corrupted column store: %s" % (path))
+
+        self.sources = header['sources']
+        self._num_rows = header['num_rows']
+        self._data_start = _align(PREAMBLE_SIZE + header_len)
+        self._columns = header['columns']
+        self._cache = {}
+
+    def __len__(self) -> int:
+        return self._num_rows
+
+    def column(self, name: str) -> memoryview:
+        '''
+        Numbers of a numeric column, or codes of a categorical column
+        '''
+        if name not in self._cache:
+            col = self._columns[name]
+            if col['type'] == STRING:
+                raise ColumnStoreError("String column: %s" % (name))
+            typecode = 'H' if col['type'] == CATEGORY else col['type']
+            self._cache[name] = self._view(col['offset'], col['size'],
+                                           typecode)
+        return self._cache[name]
+
+    def values(self, name: str) -> list:
+        '''
+        Values of the codes of a categorical column
+        '''
+        return self._columns[name]['values']
+
+    def get(self, name: str, idx: int):
+        '''
+        Value of a column in the given row
+        '''
+        col = self._columns[name]
+        if col['type'] == CATEGORY:
+            return col['values'][self.column(name)[idx]]
+        elif col['type'] != STRING:
+            return self.column(name)[idx]
+
+        if name not in self._cache:
+            self._cache[name] = self._view(col['offset'], col['size'], 'q')
+        offsets = self._cache[name]
+        start = self._data_start + col['blob_offset']
+        return self._mm[start + offsets[idx]:start + offsets[idx + 1]] \
+            .decode('utf-8')
+
+    def close(self) -> None:
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._cache = {}
+        self._mm.close()
+        self._file.close()
+
+    @staticmethod
+    def stamp(paths: list) -> list:
+        '''
+        Names, sizes and modification times of the given source files, to
+        check whether a store was built from them
+        '''
+        stamps = []
+        for path in paths:
+            stat = os.stat(path)
+            stamps.append([os.path.basename(path), stat.st_size,
+                           stat.st_mtime_ns])
+        return stamps
+
+    @staticmethod
+    def write(path: str, sources: list, spec: dict, rows) -> None:
+        '''
+        Write the given rows (dictionaries) as a column store. 'spec' maps
+        each column name to its type. Each column is streamed to an unnamed
+        temporary file every FLUSH_ROWS rows, so memory doesn't grow with
+        the number of rows (except the values of categorical columns). The
+        store is written to a temporary path and then renamed, so that a
+        partial store is never read.
+        '''
+        tmp_dir = os.path.dirname(os.path.abspath(path))
+        cols = {}
+        try:
+            # Key: column name, Value: [buffer, spill file(s), state]
+            for name, typ in spec.items():
+                if typ == STRING:
+                    cols[name] = [(array('q', [0]), bytearray()),
+                                  (tempfile.TemporaryFile(dir=tmp_dir),
+                                   tempfile.TemporaryFile(dir=tmp_dir)), 0]
+                    cols[name][0][0].tofile(cols[name][1][0])
+                elif typ == CATEGORY:
+                    cols[name] = [array('H'),
+                                  tempfile.TemporaryFile(dir=tmp_dir), {}]
+                else:
+                    cols[name] = [array(typ),
+                                  tempfile.TemporaryFile(dir=tmp_dir), None]
+
+            num_rows = 0
+            for row in rows:
+                for name, typ in spec.items():
+                    col = cols[name]
+                    if typ == STRING:
+                        offsets, blob = col[0]
+                        blob += row[name].encode('utf-8')
+                        offsets.append(col[2] + len(blob))
+                    elif typ == CATEGORY:
+                        col[0].append(col[2].setdefault(row[name],
+                                                        len(col[2])))
+                    else:
+                        col[0].append(row[name])
+                num_rows += 1
+                if num_rows % FLUSH_ROWS == 0:
+                    _flush(cols, spec)
+            _flush(cols, spec)
+
+            # Lay out the columns after the header, aligned to ALIGN bytes
+            blocks = []
+            columns = {}
+            offset = 0
+            for name, typ in spec.items():
+                col = {'type': typ}
+                if typ == STRING:
+                    offsets_file, blob_file = cols[name][1]
+                    size = offsets_file.tell()
+                    col['blob_offset'] = _align(offset + size)
+                    blocks.append((offset, offsets_file))
+                    blocks.append((col['blob_offset'], blob_file))
+                    end = col['blob_offset'] + blob_file.tell()
+                else:
+                    if typ == CATEGORY:
+                        col['values'] = list(cols[name][2].keys())
+                    size = cols[name][1].tell()
+                    blocks.append((offset, cols[name][1]))
+                    end = offset + size
+                col['offset'] = offset
+                col['size'] = size
+                columns[name] = col
+                offset = _align(end)
+
+            header = json.dumps({'version': VERSION,
+                                 'sources': sources,
+                                 'num_rows': num_rows,
+                                 'columns': columns}).encode('utf-8')
+            data_start = _align(PREAMBLE_SIZE + len(header))
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+                for block_offset, block in blocks:
+                    f.seek(data_start + block_offset)
+                    block.seek(0)
+                    shutil.copyfileobj(block, f)
+                f.truncate(data_start + offset)
+            os.replace(tmp_path, path)
+        finally:
+            for col in cols.values():
+                files = col[1] if isinstance(col[1], tuple) else (col[1], )
+                for f in files:
+                    f.close()
+
+    # ----------------- #
+    #   Local Methods   #
+    # ----------------- #
+    def _view(self, offset: int, size: int, typecode: str) -> memoryview:
+        start = self._data_start + offset
+        view = memoryview(self._mm)[start:start + size].cast(typecode)
+        self._views.append(view)
+        return view
+
+
+def _flush(cols: dict, spec: dict) -> None:
+    '''
+    Append the rows buffered by ColumnStore.write() to the spill files
+    '''
+    for name, typ in spec.items():
+        col = cols[name]
+        if typ == STRING:
+            (offsets, blob), (offsets_file, blob_file) = col[0], col[1]
+            # The first offset (the end of the last row) is already written
+            offsets[1:].tofile(offsets_file)
+            blob_file.write(blob)
+            col[2] += len(blob)
+            col[0] = (array('q', [col[2]]), bytearray())
+        else:
+            col[0].tofile(col[1])
+            col[0] = array(col[0].typecode)
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
@@ -3,11 +3,12 @@
 @author: Chang Min Park (cpark22@buffalo.edu)
 '''
 import os
+import shutil
 from subprocess import Popen, PIPE
 
 
 def run_command(command) -> str:
-    out = ''
+    out = b''
     try:
         proc = Popen(command, stdout=PIPE)
         out, err = proc.communicate()
@@ -17,8 +18,12 @@ def run_command(command) -> str:
 
 
 def mkdir_if_not_exists(path: str) -> None:
-    if not os.path.exists(path): os.mkdir(path)
+    os.makedirs(path, exist_ok=True)
 
 
 def rm(path: str) -> None:
-    os.popen("rm -rf " + path)
+    # Remove synchronously, so that the path can be written again right away
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
@@ -5,11 +5,50 @@
 import os
 
 # ----------------------- #
-#   Sleep Time Settings   #
+#   Rate Limit Settings   #
 # ----------------------- #
-ENABLE_SLEEP = True
-SLEEP_WAIT_SERVER = 600  # 10 minutes
-NUM_APPS_BETWEEN_SLEEP = 10
+# Every Google Play API request goes through a token bucket per account and
+# per endpoint. Rates grow by RATE_LIMIT_INCREASE on each success and are
+# multiplied by RATE_LIMIT_DECREASE when the server says "busy" (or 429).
+ENABLE_RATE_LIMIT = True
+RATE_LIMIT_RPS = 1.0  # Initial requests per second
+RATE_LIMIT_BURST = 5
+RATE_LIMIT_MIN_RPS = 0.02
+RATE_LIMIT_MAX_RPS = 10.0
+RATE_LIMIT_INCREASE = 0.05
+RATE_LIMIT_DECREASE = 0.5
+RATE_LIMIT_COOLDOWN = 60  # Seconds to pause an account after "busy"
+RATE_LIMIT_ENDPOINT_RPS = {
+    # Key: endpoint (e.g., "purchase"), Value: initial requests per second
+}
+
+# ------------------------ #
+#   Concurrency Settings   #
+# ------------------------ #
+NUM_WORKERS = 1  # Number of packages downloaded concurrently
+
+# Several nodes can share the packages to download through a work queue in
+# a shared SQLite database (Downloader.download_shared). A node claims a
+# package for LEASE_TIME seconds and renews its leases every
+# HEARTBEAT_INTERVAL seconds. Packages of a dead node are claimed again by
+# other nodes, up to MAX_ATTEMPTS times.
+LEASE_TIME = 600
+HEARTBEAT_INTERVAL = 60
+MAX_ATTEMPTS = 3
+QUEUE_POLL_INTERVAL = 30  # Wait for packages claimed by other nodes
+
+# AppDataParser.parse_all() splits CSV files into chunks of about
+# PARSE_CHUNK_SIZE bytes and parses them with NUM_PARSE_PROCS processes
+NUM_PARSE_PROCS = os.cpu_count() or 1
+PARSE_CHUNK_SIZE = 32 * (1 << 20)
+
+# ------------------------------------ #
+#   HTTP Connection Pool Settings      #
+# ------------------------------------ #
+# Google Play API keeps connections alive in a pool shared by the workers
+POOL_CONNECTIONS = 10  # Number of hosts to keep a pool for
+POOL_MAXSIZE = max(10, NUM_WORKERS)  # Connections kept alive per host
+MAX_RETRIES = 3  # Retries on connection errors and HTTP 500/502/504
 
 # -------------------- #
 #   Path for Command   #
@@ -17,12 +56,80 @@ NUM_APPS_BETWEEN_SLEEP = 10
 AAPT_PATH = "aapt"
 AZ = "az"
 
+# Read AndroidManifest.xml in-process (src/axml.py) and only fall back to
+# 'aapt dump badging' when the binary manifest cannot be decoded
+USE_AXML_PARSER = True
+
+# Manifests and 'aapt dump badging' results of APK files, cached by path,
+# size and modification time
+INSPECT_CACHE_SIZE = 1024
+
 # --------------- #
 #   Other Paths   #
 # --------------- #
 OUT = "out"
 DATA = "data"
 RESULT = "result.txt"
+TEMP_OUT = ".temp_out"  # Scratch space, one sub-directory per worker
+SDK_CACHE = "sdk_cache.db"  # Probed SDK versions of (package, versionCode)
+SESSION_DIR = ".gpapi_session"  # Encrypted login sessions, one per account
+AZ_INDEX = "az_index.db"  # Index of AndroZoo's latest.csv (AZ_INPUT_FILE)
+PARSE_CACHE = ".app_rank.cache"  # Column store in each app data directory
+JOB_LEDGER = "jobs.db"  # State of download jobs to resume interrupted runs
+
+# Record the state of each download job (and the bounds of its search) in
+# JOB_LEDGER, so that a restarted run skips finished jobs and resumes
+# searches. Jobs found unavailable are searched again only if
+# RETRY_UNAVAILABLE is set.
+ENABLE_JOB_LEDGER = True
+RETRY_UNAVAILABLE = False
+
+# Rank apps in PARSE_CACHE instead of parsing CSV files in
+# AppDataParser.parse_all(). The cache is rebuilt when the CSV files change.
+ENABLE_PARSE_CACHE = True
+
+# Look up SDK_CACHE before downloading a version to check its SDK versions.
+# Version codes cached as unavailable are probed again once older than
+# SDK_CACHE_UNAVAILABLE_TTL seconds, or if cached before the run when
+# RETRY_UNAVAILABLE is set.
+ENABLE_SDK_CACHE = True
+SDK_CACHE_UNAVAILABLE_TTL = 7 * 24 * 3600
+
+# Read only AndroidManifest.xml of a candidate version with HTTP Range
+# requests, and download the whole APK only once the version is accepted,
+# from the URL delivered for the probe (delivered again if it has expired).
+# A download host which ignores Range requests isn't tried again in the run.
+ENABLE_RANGE_PROBE = True
+
+# Otherwise a candidate version is downloaded into memory to check its SDK
+# versions. An accepted version is written to TEMP_OUT right away, and moved
+# to the output directory if the search chooses it. A version larger than
+# this spills into an unnamed file in TEMP_OUT, so memory is bounded by
+# PROBE_BUFFER_SIZE per probe in flight (NUM_PARALLEL_PROBES per worker).
+PROBE_BUFFER_SIZE = 32 * 1024 * 1024
+
+# Decode the manifest of a candidate version as soon as it is downloaded
+# (APKs usually start with it), and abort the download if rejected
+ENABLE_STREAM_PROBE = True
+
+# Strategy to choose version codes to probe (src/version_search.py)
+# - bisect: binary search from 0 to the latest version code
+# - gallop: from the latest version down with doubling steps, then bisect
+# - interpolate: estimate from targetSdkVersion of probed versions
+# - kary: NUM_PARALLEL_PROBES version codes splitting the range at once
+SEARCH_STRATEGY = 'bisect'
+NUM_PARALLEL_PROBES = 3
+
+# Learn the pattern of valid version codes of each app (a stride of the
+# last digits, e.g., an ABI suffix) from LATTICE_MIN_SAMPLES or more
+# versions known to exist, and probe version codes that fit it while any is
+# left in the range. A stride s learned from n codes is used only if
+# s^(n - 1) >= LATTICE_CONFIDENCE (odds of a stride by chance). Off by
+# default, since old versions of another scheme are probed only once no
+# code fitting it is left.
+ENABLE_VC_LATTICE = False
+LATTICE_MIN_SAMPLES = 3
+LATTICE_CONFIDENCE = 10000
 
 
 # ---------------------------------------- #
@@ -31,6 +138,45 @@ RESULT = "result.txt"
 class GpapiSettings:
     LOCALE = "us_US"
     TIMEZONE = "America/Chicago"
+    # Store the login session (encrypted with the account password) in
+    # SESSION_DIR and reuse it instead of a full login on the next run
+    ENABLE_SESSION_STORE = True
+    # With several accounts, requests go to the least-loaded healthy
+    # account. An account whose health (moving average of successes) drops
+    # below ACCOUNT_MIN_HEALTH, e.g., after "busy" replies, is not used for
+    # ACCOUNT_QUARANTINE seconds.
+    ACCOUNT_MIN_HEALTH = 0.3
+    ACCOUNT_QUARANTINE = 600
+    # Before downloading, get the latest version code, size and upload date
+    # of all the packages with bulkDetails requests of BULK_DETAILS_BATCH
+    # packages, NUM_BULK_REQUESTS at once, instead of a details request per
+    # package
+    ENABLE_BULK_DETAILS = True
+    BULK_DETAILS_BATCH = 100
+    NUM_BULK_REQUESTS = 4
+
+
+# -------------------------------- #
+#   Settings for AndroZoo (AZ)     #
+# -------------------------------- #
+class AzSettings:
+    MARKET = "play.google.com"
+    # Index AZ_INPUT_FILE once into AZ_INDEX, and give the az tool a small
+    # input file with only the rows of the package to download
+    ENABLE_INDEX = True
+    # Download APKs in-process by sha256 (src/androzoo.py) instead of the az
+    # tool. Requires ENABLE_INDEX.
+    USE_NATIVE_CLIENT = True
+    URL = "https://androzoo.uni.lu/api/download"
+    NUM_DOWNLOADS = 4  # Concurrent transfers
+    RETRY_BACKOFF = 1.0  # Seconds before the first retry, doubled each time
+    TIMEOUT = 60
+    # Candidate versions are downloaded CANDIDATE_BATCH at a time (or
+    # NUM_DOWNLOADS with the native client, if more), ordered by how close
+    # their dex_date is to SDK_ADOPTION_DAYS after the release of the target
+    # SDK version, until a version of the SDK version is found
+    CANDIDATE_BATCH = 2
+    SDK_ADOPTION_DAYS = 180
 
 
 # ---------------------------------- #
@@ -42,6 +188,9 @@ class GpLoginCredentials:
     PASSWORD = "GPAPI_PASSWORD"
     GSFID = "GPAPI_GSFID"
     TOKEN = "GPAPI_TOKEN"
+    # Optional. A file with an account per line (email,password) to use
+    # several accounts instead of the one above
+    ACCOUNTS = "GPAPI_ACCOUNTS"
 
 
 class AzCredentials:
@@ -5,19 +5,38 @@
 
 import sys
 import os
-import math
-import time
 import glob
-from typing import Tuple
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import IO, Callable, Iterator, Tuple
+from urllib.parse import urlparse
 
 # Local package
-from src.gpapi.googleplay import GooglePlayAPI
+from src.gpapi.googleplay import RequestError, LoginError
+from src.gpapi.googleplay import RangeNotSupportedError
 from src.logger import Logger
+from src.account_pool import Account, AccountPool
+from src.sdk_cache import SdkCache
+from src.remote_zip import RemoteZip, RemoteZipError, LocalEntryReader
+from src.session_store import SessionStore
+from src.az_index import AzIndex
+from src.androzoo import AndroZooClient, AndroZooError
+from src.job_ledger import JobLedger
+from src.work_queue import WorkQueue
+import src.job_ledger as jl
+import src.version_search as vs
 import src.aapt_utils as aapt
+import src.axml as axml
 import src.common as common
 from src.config import GpLoginCredentials as GPAPI_C
 from src.config import GpapiSettings as GS
 from src.config import AzCredentials as AZ_C
+from src.config import AzSettings as AS
 import src.config as cfg
 
 encoding = "utf-8"
@@ -31,59 +50,358 @@ class Downloader:
     MODE_AZ = 'AZ'
 
     def __init__(self, mode: str, sdk_version: str, \
-                                    sdk_version_match: bool=False) -> None:
-        self._sdk_version = str(sdk_version) if sdk_version else 'latest'
+                                    sdk_version_match: bool=False,
+                                    num_workers: int=cfg.NUM_WORKERS,
+                                    accounts: list=None,
+                                    search_strategy: str=\
+                                        cfg.SEARCH_STRATEGY) -> None:
+        # 'sdk_version' can also be a set of SDK versions (matrix mode)
+        # 'accounts' is a list of Google accounts (email, password) for GPAPI
+        # 'search_strategy' chooses version codes to probe for GPAPI (see
+        # src/version_search.py)
+        self._sdk_versions = self._to_sdk_versions(sdk_version)
         self._sdk_version_match = sdk_version_match
-        self._tried = 0
+        self._num_workers = max(1, num_workers)
+        self._search_strategy = search_strategy
         self._logger = Logger.get_instance()
-        self._gpapi_server = \
-            GooglePlayAPI(locale=GS.LOCALE, timezone=GS.TIMEZONE)
+        self._az_index = None
+        self._az_client = None
+        # Key: package name, Value: latest version from bulkDetails (None if
+        # the app doesn't exist)
+        self._app_details = {}
+        # Download hosts which ignored HTTP Range requests
+        self._no_range_hosts = set()
+
+        # Probed SDK versions of (package, versionCode) shared across runs
+        self._sdk_cache = SdkCache(cfg.SDK_CACHE,
+                                   0 if cfg.RETRY_UNAVAILABLE
+                                   else cfg.SDK_CACHE_UNAVAILABLE_TTL) \
+            if cfg.ENABLE_SDK_CACHE else None
 
         # Set the mode
         self._mode = mode
         self._check_mode_validity()
-        self._check_env_for_mode()
+        if search_strategy not in vs.STRATEGIES:
+            sys.exit("Invalid search strategy: %s (%s)" %
+                     (search_strategy, ", ".join(vs.STRATEGIES)))
+        self._check_env_for_mode(accounts)
 
-    def download_all(self, pkg_list: list, out_path: str) -> None:
+        # Google Play API requests are spread over the accounts, each with
+        # its own session and rate limiter
+        self._accounts = None
+        if self._mode == Downloader.MODE_GPAPI:
+            pool_maxsize = max(cfg.POOL_MAXSIZE, self._num_workers *
+                               max(1, cfg.NUM_PARALLEL_PROBES))
+            self._accounts = AccountPool(
+                [Account(email, password, pool_maxsize=pool_maxsize)
+                 for email, password in self._get_credentials(accounts)])
+
+        # State of download jobs shared across runs
+        self._job_ledger = JobLedger(cfg.JOB_LEDGER, self._mode) \
+            if cfg.ENABLE_JOB_LEDGER else None
+
+    def download_all(self, pkg_list: list, out_path: str,
+                     sdk_versions: set = None) -> None:
         '''
         Download apps in the given list for the given sdk version.
+        - If 'sdk_versions' is given, it overrides the sdk version(s) given
+          to the constructor. For multiple SDK versions, a single search per
+          app places an APK in each out/<sdk>/<cat>/ directory.
         '''
-        # Login if the given mode is GPAPI
-        if self._mode == Downloader.MODE_GPAPI: self._login_gpapi()
+        sdk_versions = self._sdk_versions if sdk_versions is None \
+            else self._to_sdk_versions(sdk_versions)
+        self._prepare_mode()
+        self._prefetch_details([pkg_name for pkg_name, _ in pkg_list])
 
         # Download apps with either Google Play API or AndroZoo tool
-        for pkg_name, cat in pkg_list:
-            downloaded = self._prep_out_path(out_path, cat, pkg_name)
-            if downloaded: continue
+        if self._num_workers == 1:
+            scratch = os.path.join(cfg.TEMP_OUT, 'worker_0')
+            for pkg_name, cat in pkg_list:
+                self._download_pkg(pkg_name, cat, out_path, scratch,
+                                   sdk_versions)
 
-            msg = "[%s] Downloading %s ..." % (self._mode, pkg_name)
-            self._logger.info(msg)
-            apk_path = self._get_apk_path(out_path, cat, pkg_name)
-            if self._mode == Downloader.MODE_GPAPI:
-                self._download_gpapi(pkg_name, apk_path)
-            elif self._mode == Downloader.MODE_AZ:
-                self._download_az(pkg_name, apk_path)
+        # Concurrent mode: N workers pull packages from a shared queue
+        else:
+            pkg_queue = queue.Queue()
+            for item in pkg_list:
+                pkg_queue.put(item)
+            workers = []
+            for idx in range(min(self._num_workers, len(pkg_list))):
+                scratch = os.path.join(cfg.TEMP_OUT, 'worker_%d' % (idx))
+                worker = threading.Thread(target=self._worker,
+                                          args=(pkg_queue, out_path, scratch,
+                                                sdk_versions),
+                                          name='worker_%d' % (idx),
+                                          daemon=True)
+                worker.start()
+                workers.append(worker)
+            for worker in workers:
+                worker.join()
+
+        self._log_stats()
+
+    def download_shared(self, queue_path: str, pkg_list: list, out_path: str,
+                        sdk_versions: set = None, node_id: str = None) -> None:
+        '''
+        Download apps together with other nodes sharing the work queue at
+        'queue_path' (a SQLite database, e.g., on NFS). Each node claims
+        packages one at a time, so adding a node adds throughput without
+        splitting 'pkg_list'. Every node may enqueue the same 'pkg_list'.
+        - Nodes using the same account share its rate budget, for each of
+          their accounts
+        - Packages of a dead node are claimed again once their leases expire
+        '''
+        sdk_versions = self._sdk_versions if sdk_versions is None \
+            else self._to_sdk_versions(sdk_versions)
+        accounts = None
+        if self._mode == Downloader.MODE_GPAPI:
+            accounts = [a.email for a in self._accounts.accounts]
+        work_queue = WorkQueue(queue_path, node_id=node_id, accounts=accounts)
+        if pkg_list:
+            work_queue.enqueue(pkg_list)
+        self._prepare_mode()
+        self._prefetch_details([pkg_name for pkg_name, _ in pkg_list or []])
+        self._logger.info("Joined the work queue as %s" % (work_queue.node_id))
+
+        # Renew leases and adjust the rate budget in the background
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat,
+                                     args=(work_queue, stop),
+                                     name='heartbeat', daemon=True)
+        heartbeat.start()
+
+        workers = []
+        for idx in range(self._num_workers):
+            scratch = os.path.join(cfg.TEMP_OUT, 'worker_%d' % (idx))
+            worker = threading.Thread(target=self._shared_worker,
+                                      args=(work_queue, out_path, scratch,
+                                            sdk_versions),
+                                      name='worker_%d' % (idx),
+                                      daemon=True)
+            worker.start()
+            workers.append(worker)
+        try:
+            for worker in workers:
+                worker.join()
+        finally:
+            stop.set()
+            heartbeat.join()
+            work_queue.leave()
+
+        summary = work_queue.get_summary()
+        self._logger.info("Work queue: " + ", ".join(
+            ["%d %s" % (v, k) for k, v in sorted(summary['states'].items())]))
+        for node, num_done in sorted(summary['nodes'].items()):
+            self._logger.info(" - %s: %d packages" % (node, num_done))
+        work_queue.close()
+        self._log_stats()
 
     # ----------------- #
     #   Local Methods   #
     # ----------------- #
-    def _download_gpapi(self, pkg_name: str, apk_path: str) -> str:
+    def _prepare_mode(self) -> None:
+        '''
+        Login if the given mode is GPAPI, or index AndroZoo's app list if
+        the given mode is AZ (only once)
+        '''
+        if self._mode == Downloader.MODE_GPAPI: self._login_gpapi()
+
+        if self._mode == Downloader.MODE_AZ and AS.ENABLE_INDEX \
+                and self._az_index is None:
+            self._az_index = AzIndex(cfg.AZ_INDEX,
+                                     os.environ[AZ_C.INPUT_FILE])
+        if self._az_index and AS.USE_NATIVE_CLIENT \
+                and self._az_client is None:
+            self._az_client = AndroZooClient(os.environ[AZ_C.API_KEY])
+
+    def _prefetch_details(self, pkg_names: list) -> None:
+        '''
+        Get the latest version of the given packages with batched
+        bulkDetails requests sent concurrently. Packages missed (e.g., the
+        request failed) are looked up with a details request later.
         '''
-        Download the app paackage to the given path with Google Play API
+        if self._mode != Downloader.MODE_GPAPI or not GS.ENABLE_BULK_DETAILS:
+            return
+        pkg_names = sorted(set(pkg_names) - set(self._app_details))
+        batch = max(1, GS.BULK_DETAILS_BATCH)
+        batches = [pkg_names[i:i + batch]
+                   for i in range(0, len(pkg_names), batch)]
+        if not batches: return
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max(1, GS.NUM_BULK_REQUESTS)) as executor:
+            futures = [executor.submit(self._call_gpapi, 'bulkAppDetails',
+                                       names) for names in batches]
+            for future in as_completed(futures):
+                try:
+                    self._app_details.update(future.result())
+                except Exception as e:
+                    self._logger.warning("GPAPI failed to get bulk details. "
+                                         "%s" % (e))
+        num_found = len([pkg_name for pkg_name in pkg_names
+                         if self._app_details.get(pkg_name)])
+        self._logger.info("GPAPI: latest versions of %d/%d apps in %d "
+                          "requests (%.1fs)" %
+                          (num_found, len(pkg_names), len(batches),
+                           time.monotonic() - start))
+
+    def _log_stats(self) -> None:
+        if self._mode == Downloader.MODE_GPAPI: self._log_gpapi_stats()
+        if self._job_ledger:
+            summary = self._job_ledger.get_summary()
+            self._logger.info("Jobs: " + ", ".join(
+                ["%d %s" % (summary[k], k) for k in sorted(summary)]))
+
+    def _heartbeat(self, work_queue: WorkQueue,
+                   stop: threading.Event) -> None:
+        '''
+        Renew leases of the work queue, and split each account's rate among
+        the live nodes using it
+        '''
+        while True:
+            try:
+                num_nodes = work_queue.heartbeat()
+                for account in self._accounts.accounts \
+                        if self._accounts else []:
+                    if account.rate_limiter:
+                        account.rate_limiter.set_max_rate(
+                            cfg.RATE_LIMIT_MAX_RPS /
+                            num_nodes.get(account.email, 1))
+            except Exception as e:
+                self._logger.warning("Heartbeat failed. %s" % (e))
+            if stop.wait(cfg.HEARTBEAT_INTERVAL):
+                return
+
+    def _shared_worker(self, work_queue: WorkQueue, out_path: str,
+                       scratch: str, sdk_versions: list) -> None:
+        '''
+        Keep claiming packages from the shared work queue until every
+        package is done or failed
+        '''
+        while True:
+            task = work_queue.claim()
+            if task is None:
+                # Packages claimed by other nodes may still come back
+                if work_queue.is_finished():
+                    return
+                time.sleep(cfg.QUEUE_POLL_INTERVAL)
+                continue
+
+            pkg_name, cat = task
+            try:
+                err = self._download_pkg(pkg_name, cat, out_path, scratch,
+                                         sdk_versions)
+                if not work_queue.complete(pkg_name, cat, err):
+                    self._logger.warning("Lease of %s was lost" % (pkg_name))
+            except Exception as e:
+                self._logger.warning("[%s] Failed to download %s. %s" %
+                                     (self._mode, pkg_name, e))
+                work_queue.fail(pkg_name, cat, str(e))
+
+    def _worker(self, pkg_queue: queue.Queue, out_path: str, scratch: str,
+                sdk_versions: list) -> None:
+        '''
+        Keep downloading packages from the shared queue until it is empty
+        '''
+        while True:
+            try:
+                pkg_name, cat = pkg_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self._download_pkg(pkg_name, cat, out_path, scratch,
+                                   sdk_versions)
+            except Exception as e:
+                self._logger.warning("[%s] Failed to download %s. %s" %
+                                     (self._mode, pkg_name, e))
+
+    def _download_pkg(self, pkg_name: str, cat: str, out_path: str,
+                      scratch: str, sdk_versions: list) -> str:
+        '''
+        Download a single package for each of the given SDK versions with
+        either Google Play API or AndroZoo tool. 'scratch' is a temporary
+        directory owned by the caller. Returns an error message unless all
+        SDK versions were downloaded.
+        '''
+        # Key: SDK version not downloaded yet, Value: APK path
+        apk_paths = {}
+        for sdk_version in sdk_versions:
+            downloaded = self._prep_out_path(out_path, cat, pkg_name,
+                                             sdk_version)
+            if downloaded:
+                continue
+            apk_path = self._get_apk_path(out_path, cat, pkg_name, sdk_version)
+
+            # Skip jobs found unavailable in previous runs
+            if self._job_ledger:
+                job = self._job_ledger.add(apk_path, pkg_name, sdk_version)
+                if job['state'] == jl.UNAVAILABLE \
+                        and not cfg.RETRY_UNAVAILABLE:
+                    self._logger.info('Skip for unavailable app: %s (%s). %s'
+                                      % (pkg_name, sdk_version, job['reason']))
+                    continue
+            apk_paths[sdk_version] = apk_path
+        if not apk_paths: return None
+
+        msg = "[%s] Downloading %s ..." % (self._mode, pkg_name)
+        self._logger.info(msg)
+        common.mkdir_if_not_exists(scratch)
+        try:
+            if self._mode == Downloader.MODE_GPAPI:
+                err = self._download_gpapi(pkg_name, apk_paths, scratch)
+            elif self._mode == Downloader.MODE_AZ:
+                err = self._download_az(pkg_name, apk_paths, scratch)
+            return err.strip(' -') if err else None
+        except Exception as e:
+            # Jobs interrupted by the error are retried on the next run
+            for apk_path in apk_paths.values():
+                job = self._job_ledger.get(apk_path) \
+                    if self._job_ledger else None
+                if job and job['state'] in [jl.PENDING, jl.SEARCHING]:
+                    self._set_job_state(apk_path, jl.FAILED, str(e))
+            raise
+
+    def _download_gpapi(self, pkg_name: str, apk_paths: dict,
+                        scratch: str = cfg.TEMP_OUT) -> str:
+        '''
+        Download the app paackage to the given paths with Google Play API
+        - 'apk_paths' maps each target SDK version to its output path
         - If 'sdk_version' is not given, download the latest version
-        - If 'sdk_version' is given, find and download using binary serach
+        - If 'sdk_version' is given, find and download using binary serach.
+          Probes are shared by all the target SDK versions.
         '''
+        def request_apk(vc: int = None,
+                        fetch_data: bool = True) -> Tuple[dict, str]:
+            # Requests are paced by the rate limiter of GooglePlayAPI, which
+            # backs off when the server rejects frequent requests
+            try:
+                fl = self._call_gpapi('download', pkg_name) if vc is None \
+                    else self._call_gpapi('download', pkg_name, versionCode=vc,
+                                          fetch_data=fetch_data)
+                return fl, None
+            except RequestError as e:
+                # The server answered, so the version is not available unless
+                # it was just too busy to answer
+                if "busy" in str(e).lower():
+                    transient.add(vc)
+                elif vc is not None and self._sdk_cache:
+                    self._sdk_cache.put(pkg_name, vc, available=False)
+                err = ' - GPAPI failed to download (vc: %s). %s' % (vc, e)
+                self._logger.debug(err)
+                return None, str(e)
+            except Exception as e:
+                transient.add(vc)
+                err = ' - GPAPI failed to download (vc: %s). %s' % (vc, e)
+                self._logger.debug(err)
+                return None, str(e)
+
         def download_inner(pkg_name: str,
                            apk_path: str,
                            vc: str = None) -> Tuple[bool, str]:
-            # Sleep for every given app numbers because of Google API's
-            # rejections for frequent requests
-            self._tried += 1
-            if cfg.ENABLE_SLEEP and self._tried % cfg.NUM_APPS_BETWEEN_SLEEP == 0:
-                time.sleep(cfg.SLEEP_WAIT_SERVER // 10)
+            fl, err = request_apk(vc)
+            if fl is None:
+                return False, err
             try:
-                fl = self._gpapi_server.download(pkg_name) if vc is None \
-                    else self._gpapi_server.download(pkg_name, versionCode=vc)
                 self._write_apk(fl, apk_path)
                 return True, None
             except Exception as e:
@@ -91,123 +409,439 @@ class Downloader:
                 self._logger.debug(err)
                 return False, str(e)
 
-        def get_latest_vc(pkg_name: str) -> str:
-            # Get the latest version code from Google Play API server
+        def fetch_inner(vc: int, apk_path: str) -> Tuple[bool, str]:
+            # Download a version accepted by a Range probe from the URL it
+            # was delivered at, without another purchase and delivery
+            delivery = delivered.pop(vc)
             try:
-                latest_vc = self._gpapi_server.details(pkg_name)\
-                        .get('details').get('appDetails').get('versionCode')
-                return latest_vc
-            except Exception as err:
-                return str(err)
+                fl = {'file': self._call_gpapi('fetchFile', delivery['url'],
+                                               delivery['cookies'])}
+                self._write_apk(fl, apk_path)
+                return True, None
+            except Exception as e:
+                err = ' - GPAPI failed to fetch (vc: %s). %s' % (vc, e)
+                self._logger.debug(err)
+                return False, str(e)
 
-        # Download the Latest Version if SDK version is not provided
-        if self._sdk_version is 'latest':
-            res, err = download_inner(pkg_name, apk_path)
+        def probe(vc: int, cancel: threading.Event = None) \
+                -> Tuple[bool, int, int, str]:
+            # Read SDK versions of the given version. Only the manifest is
+            # fetched with HTTP Range requests if possible, otherwise the
+            # version is downloaded into a memory buffer (aborted once its
+            # manifest arrives if rejected) and kept there if any target SDK
+            # version accepts it. The delivery of a version accepted by a
+            # Range probe is kept to download it from.
+            # Returns (available, min_sdk, tgt_sdk, err), or None if the
+            # probe was cancelled with 'cancel'
+            fl, manifest = None, None
+            if cancel is not None and cancel.is_set():
+                return None
+            if cfg.ENABLE_RANGE_PROBE:
+                fl, err = request_apk(vc, fetch_data=False)
+                if fl is None:
+                    return False, -1, -1, err
+                manifest, size = self._read_remote_manifest(fl.get('file'),
+                                                            cancel)
+                if manifest is None and cancel is not None \
+                        and cancel.is_set():
+                    return None
+                if manifest is not None and is_accepted(manifest):
+                    delivered[vc] = fl.get('file')
+            if manifest is None:
+                if fl is None:
+                    fl, err = request_apk(vc)
+                    if fl is None:
+                        return False, -1, -1, err
+                try:
+                    # Download the version delivered for the range probe
+                    if 'data' not in fl.get('file'):
+                        fl['file'] = self._call_gpapi(
+                            'fetchFile', fl.get('file').get('url'),
+                            fl.get('file').get('cookies'))
+                    buffer, manifest = self._buffer_apk(fl, scratch,
+                                                        accept=is_accepted,
+                                                        cancel=cancel)
+                except Exception as e:
+                    # e.g., the connection was lost, not an unavailable one
+                    transient.add(vc)
+                    err = ' - GPAPI failed to download (vc: %s). %s' % (vc, e)
+                    self._logger.debug(err)
+                    return False, -1, -1, str(e)
+                if buffer is None and manifest is None:
+                    return None
+                if buffer is None:
+                    size = int(fl.get('file').get('total_size') or -1)
+                else:
+                    if manifest is None:
+                        manifest = aapt.get_manifest(buffer)
+                    size = buffer.seek(0, os.SEEK_END)
+                    # Write an accepted version out of memory right away
+                    with buffer:
+                        if is_accepted(manifest):
+                            path = os.path.join(scratch, '%s_%d.apk' %
+                                                (pkg_name, vc))
+                            self._save_apk(buffer, path)
+                            kept[vc] = path
+            min_sdk_app = manifest['minSdkVersion']
+            tgt_sdk_app = manifest['targetSdkVersion']
+            if self._sdk_cache:
+                self._sdk_cache.put(pkg_name, vc, True, min_sdk_app,
+                                    tgt_sdk_app, size)
+            return True, min_sdk_app, tgt_sdk_app, None
 
-        # Find and download the target SDK version
-        else:
-            latest_vc = get_latest_vc(pkg_name)
-            if not latest_vc:
-                err = " - Couldn't find version code information for %s." \
-                    %(pkg_name)+ "\n - try downloading for the latest version."
-                self._logger.warning(err)
-                res, err = download_inner(pkg_name, apk_path)
+        def is_accepted(manifest: dict) -> bool:
+            # Whether any target SDK version accepts the given version
+            return any([self._check_sdk_version(int(sdk),
+                        manifest['minSdkVersion'],
+                        manifest['targetSdkVersion'])
+                        for sdk in apk_paths if sdk != 'latest'])
 
+        def get_probe(vc: int, cancel: threading.Event = None) \
+                -> Tuple[bool, int, int, str]:
+            # Reuse probes of this search and the cache before probing
+            if vc in probed:
+                return probed[vc]
+            cached = self._sdk_cache.get(pkg_name, vc) \
+                if self._sdk_cache else None
+            if cached:
+                probed[vc] = (cached['available'], cached['min_sdk'],
+                              cached['tgt_sdk'], None)
             else:
-                l_vc, r_vc, prev_tried_vc = 0, latest_vc, 0
-                l_vc_not_found = None
-                while True:
-                    if l_vc_not_found:
-                        vc = math.ceil((l_vc_not_found + r_vc) / 2)
+                result = probe(vc, cancel)
+                if result is None:
+                    return None
+                probed[vc] = result
+            observed[vc] = probed[vc][2] if probed[vc][0] else None
+            if lattice and probed[vc][0]:
+                lattice.add(vc)
+            return probed[vc]
+
+        def get_probes(vcs: list, strategy: vs.SearchStrategy) -> Iterator:
+            # Probe the given version codes at once, and yield (vc, probe)
+            # in version-code order, each once all the lower ones complete,
+            # so that the search doesn't depend on which probe is faster
+            # (e.g., an unavailable version code skips those below it).
+            # Probes left out of the strategy's range are cancelled or
+            # dropped, and the rest are cancelled once the caller stops.
+            if len(vcs) == 1:
+                yield vcs[0], get_probe(vcs[0])
+                return
+            cancels = {vc: threading.Event() for vc in vcs}
+            futures = {executor.submit(get_probe, vc, cancels[vc]): vc
+                       for vc in vcs}
+            pending, results = sorted(vcs), {}
+            try:
+                for future in as_completed(futures):
+                    results[futures[future]] = None if future.cancelled() \
+                        else future.result()
+                    while pending and pending[0] in results:
+                        vc = pending.pop(0)
+                        if results[vc] is not None and strategy.contains(vc):
+                            yield vc, results[vc]
+                    for f, vc in futures.items():
+                        if not f.done() and not strategy.contains(vc):
+                            cancels[vc].set()
+                            f.cancel()
+            finally:
+                for cancel in cancels.values():
+                    cancel.set()
+
+        def search(sdk_version: int, latest_vc: int,
+                   target: str) -> Tuple[int, str]:
+            # Search for a version code accepted by the given SDK version
+            # with the search strategy. Returns (version code or None, err)
+            # Continue from the bounds of the job's last search if any
+            bounds = self._job_ledger.get_bounds(target) \
+                if self._job_ledger else None
+            strategy = vs.STRATEGIES[self._search_strategy](
+                sdk_version, latest_vc, bounds, observed, lattice)
+            if bounds:
+                self._logger.debug(' - Resume search (sdk_version: %d, '
+                                   'l_vc: %d, r_vc: %d)' %
+                                   (sdk_version, bounds['l_vc'],
+                                    bounds['r_vc']))
+            # Bounds are saved only until a probe fails for a while, which
+            # the strategy takes as unavailable
+            num_transient = len(transient)
+            while True:
+                if self._job_ledger and len(transient) == num_transient:
+                    self._job_ledger.save_bounds(target,
+                                                 strategy.get_bounds())
+                vcs = strategy.next_vcs(cfg.NUM_PARALLEL_PROBES)
+                if not vcs:
+                    if strategy.unavailable:
+                        err = " - download unavailable for the given " +\
+                             "sdk_version: %s" %(sdk_version)
                     else:
-                        vc = math.ceil((l_vc + r_vc) / 2)
-
-                    if prev_tried_vc == vc:
-                        if vc == l_vc_not_found:
-                            err = " - download unavailable for the given " +\
-                                 "sdk_version: %s" %(self._sdk_version)
-                        else:
-                            err = " - does not exist for the given " +\
-                                "sdk_version: %s" %(self._sdk_version)
-                        self._logger.debug(err)
-                        res = False
-                        break
-
-                    # Download
-                    prev_tried_vc = vc
-                    res, err = download_inner(pkg_name, apk_path, vc=vc)
+                        err = " - does not exist for the given " +\
+                            "sdk_version: %s" %(sdk_version)
+                    self._logger.debug(err)
+                    return None, err
+
+                # Look up previous probes first, and probe if not probed yet
+                for vc, (res, min_sdk_app, tgt_sdk_app, err) in \
+                        get_probes(vcs, strategy):
                     if not res:
-                        l_vc = vc
-                        l_vc_not_found = l_vc
+                        strategy.update(vc, None)
                         continue
 
                     # Find targetSdkVersion information
-                    min_sdk_app = aapt.get_min_sdk_version(apk_path)
-                    tgt_sdk_app = aapt.get_tgt_sdk_version(apk_path)
                     if tgt_sdk_app == -1 or min_sdk_app == -1:
                         err = " - SDK versions are not found in manifest "+\
                             "(minSdkVersion or targetSdkVersion)."
                         self._logger.warning(err)
-                        common.rm(apk_path)
-                        res = False
-                        break
+                        return None, err
 
-                    # Download succeeded
-                    if self._check_sdk_version(int(self._sdk_version),
+                    # Found
+                    if self._check_sdk_version(sdk_version,
                                                min_sdk_app=min_sdk_app,
                                                tgt_sdk_app=tgt_sdk_app):
-                        res = True
-                        break
-
-                    # If targetSdkVersion is different, delete and continue
-                    elif tgt_sdk_app > int(self._sdk_version):
-                        if l_vc_not_found:
-                            l_vc = math.ceil((vc + l_vc_not_found) / 2)
-                        r_vc = vc
-                        common.rm(apk_path)
-                        continue
-                    elif tgt_sdk_app < int(self._sdk_version):
-                        l_vc = vc
-                        l_vc_not_found = None
-                        common.rm(apk_path)
-                        continue
+                        return vc, None
 
-        msg = " - Found an app with the given SDK version." if res else \
-        " - Couldn't find an app for any of the given SDK versions."
-        self._logger.info(msg)
+                    # If targetSdkVersion is different, continue
+                    strategy.update(vc, tgt_sdk_app)
 
-        # Sleep awhile for download fails
-        if err and "busy" in err.lower():
-            time.sleep(cfg.SLEEP_WAIT_SERVER)
-        return None if res else err
+        def get_latest_vc(pkg_name: str) -> int:
+            # Prefetched with bulkDetails (see _prefetch_details())
+            if pkg_name in self._app_details:
+                details = self._app_details[pkg_name]
+                if not details:
+                    self._logger.debug(' - GPAPI found no details.')
+                    return None
+                self._logger.debug(' - Latest version: %d (%d bytes, %s)' %
+                                   (details['versionCode'],
+                                    details['installationSize'],
+                                    details['uploadDate']))
+                return details['versionCode']
+
+            # Get the latest version code from Google Play API server
+            try:
+                latest_vc = self._call_gpapi('details', pkg_name)\
+                        .get('details').get('appDetails').get('versionCode')
+                return latest_vc
+            except Exception as err:
+                self._logger.debug(' - GPAPI failed to get details. %s' %
+                                   (err))
+                return None
+
+        # Key: version code, Value: result of probe() in this search
+        probed = {}
+        # Key: version code, Value: targetSdkVersion (None if unavailable)
+        observed = {}
+        # Pattern of valid version codes learned from available versions
+        lattice = vs.VersionLattice() if cfg.ENABLE_VC_LATTICE else None
+        # Key: version code, Value: scratch file of a fully downloaded probe
+        kept = {}
+        # Key: version code, Value: 'url' and 'cookies' of the delivery of
+        # an accepted Range probe
+        delivered = {}
+        # Version codes that failed for reasons other than being unavailable
+        transient = set()
+        # Key: SDK version, Value: version code found
+        found, err = {}, None
+
+        # Download the Latest Version if SDK version is not provided
+        if 'latest' in apk_paths:
+            found['latest'] = None
 
-    def _download_az(self, pkg_name: str, apk_path: str) -> bool:
+        # Find the target SDK versions
+        latest_vc = None
+        if len(found) < len(apk_paths):
+            latest_vc = get_latest_vc(pkg_name)
+            if not latest_vc:
+                err = " - Couldn't find version code information for %s." \
+                    %(pkg_name)+ "\n - try downloading for the latest version."
+                self._logger.warning(err)
+            elif lattice:
+                lattice.add(latest_vc)
+                cached = self._sdk_cache.get_all(pkg_name) \
+                    if self._sdk_cache else {}
+                for vc, entry in cached.items():
+                    if entry['available'] and vc <= latest_vc:
+                        lattice.add(vc)
+        # Concurrent probes of a search (see get_probes()), all finished or
+        # cancelled before the probes kept are used
+        with ThreadPoolExecutor(max(1, cfg.NUM_PARALLEL_PROBES)) as executor:
+            for sdk_version in apk_paths:
+                if sdk_version == 'latest' or not latest_vc:
+                    found[sdk_version] = None
+                    continue
+                vc, err = search(int(sdk_version), latest_vc,
+                                 apk_paths[sdk_version])
+                if vc is not None:
+                    found[sdk_version] = vc
+                else:
+                    # Not found for sure only if every probe got an answer
+                    self._set_job_state(apk_paths[sdk_version],
+                                        jl.FAILED if transient
+                                        else jl.UNAVAILABLE, err)
+
+        # Download each version found once, then copy it to other targets
+        downloaded = []
+        for vc in set(found.values()):
+            paths = [apk_paths[sdk] for sdk in found if found[sdk] == vc]
+            res = False
+            if vc in kept:
+                self._move_apk(kept.pop(vc), paths[0])
+                res = True
+            elif vc in delivered:
+                res, err = fetch_inner(vc, paths[0])
+            if not res:
+                # e.g., the delivered URL has expired
+                res, err = download_inner(pkg_name, paths[0], vc)
+            if not res:
+                for path in paths:
+                    self._set_job_state(path, jl.FAILED, err, vc)
+                continue
+            for path in paths[1:]:
+                shutil.copyfile(paths[0], path)
+            for path in paths:
+                self._set_job_state(path, jl.DOWNLOADED, None, vc)
+            downloaded += [sdk for sdk in found if found[sdk] == vc]
+        for path in kept.values():
+            common.rm(path)
+
+        for sdk_version in apk_paths:
+            msg = " - Found an app with the given SDK version." \
+                if sdk_version in downloaded else \
+                " - Couldn't find an app for any of the given SDK versions."
+            if len(apk_paths) > 1:
+                msg += " (sdk_version: %s)" % (sdk_version)
+            self._logger.info(msg)
+        return None if len(downloaded) == len(apk_paths) else err
+
+    def _download_az(self, pkg_name: str, apk_paths: dict,
+                     tmp_out: str = cfg.TEMP_OUT) -> bool:
         '''
-        Download the given app using AndroZoo tool
+        Download the given app using AndroZoo tool, or AndroZoo's API
+        directly if the native client is enabled
+        - 'apk_paths' maps each target SDK version to its output path
+        - 'tmp_out' is a scratch directory to store candidate versions
         '''
-        def download_inner(path: str):
+        def download_inner(path: str, rows: list = None):
+            # 'rows' are the candidates from the index to download into the
+            # directory 'path' (all versions after the SDK release if None)
+            if self._az_client:
+                download_native(path, rows)
+                return
+            if rows is not None:
+                self._az_index.write_csv(rows, input_file)
             command = [cfg.AZ, \
                 '-k', os.environ[AZ_C.API_KEY], \
-                '-i', os.environ[AZ_C.INPUT_FILE], \
+                '-i', input_file, \
                 '-pn', pkg_name, \
-                '-m', 'play.google.com', \
+                '-m', AS.MARKET, \
                 '-o', path
             ]
-            if not self._sdk_version == 'latest':
-                # sdk_release_date = cfg.SDK_VERSION_DATE[int(self._sdk_version)]
-                sdk_release_date = '2008-09-23'
+            if not 'latest' in apk_paths and rows is None:
+                sdk_release_date = cfg.SDK_VERSION_DATE.get(
+                    min([int(sdk) for sdk in pending]), '2008-09-23')
                 command += ['-d', sdk_release_date + ':']
             common.run_command(command)
 
+        def download_native(path: str, rows: list = None):
+            # The latest is the last row (rows are sorted by versionCode)
+            if rows is None:
+                try:
+                    self._az_client.download(apks[-1]['sha256'], path)
+                except AndroZooError as e:
+                    self._logger.info(" - Failed to download %s from "
+                                      "AndroZoo. %s" % (pkg_name, e))
+                return
+            errors = self._az_client.download_all(
+                [(apk['sha256'], os.path.join(path, apk['sha256'] + '.apk'))
+                 for apk in rows])
+            failed = [sha256 for sha256, e in errors.items() if e]
+            if failed:
+                self._logger.info(" - Failed to download %d of %d versions "
+                                  "of %s from AndroZoo." %
+                                  (len(failed), len(errors), pkg_name))
+
+        def check_apks(apks_downloaded: list):
+            # If target sdk version found, move the app to out_dir
+            nonlocal err
+            for apk in apks_downloaded:
+                manifest = aapt.get_manifest(apk)
+                min_sdk_app = manifest['minSdkVersion']
+                tgt_sdk_app = manifest['targetSdkVersion']
+                if tgt_sdk_app == -1 or min_sdk_app == -1:
+                    err = " - SDK versions are not found in manifest " + \
+                            "(minSdkVersion or targetSdkVersion)."
+                    self._logger.debug(err)
+                    common.rm(apk)
+                    continue
+
+                msg = "  - %s (minSdkVersion: %d, targetSdkVersion: %d)" \
+                    %(apk, min_sdk_app, tgt_sdk_app)
+                self._logger.debug(msg)
+
+                for sdk_version in list(pending):
+                    if self._check_sdk_version(target_sdk=int(sdk_version),
+                                               min_sdk_app=min_sdk_app,
+                                               tgt_sdk_app=tgt_sdk_app):
+                        shutil.copyfile(apk, apk_paths[sdk_version])
+                        pending.remove(sdk_version)
+                        downloaded_sdks.append(sdk_version)
+                        self._set_job_state(apk_paths[sdk_version],
+                                            jl.DOWNLOADED, None,
+                                            manifest['versionCode'])
+                if not pending:
+                    break
+
+        # Give the az tool only the rows of this package from the index, so
+        # that it doesn't read the whole app list for every package
+        input_file = os.environ[AZ_C.INPUT_FILE]
+        if self._az_index:
+            apks = self._az_index.lookup(pkg_name, market=AS.MARKET)
+            if not apks:
+                err = " - Not found in AndroZoo: %s" % (pkg_name)
+                self._logger.info(err)
+                for apk_path in apk_paths.values():
+                    self._set_job_state(apk_path, jl.UNAVAILABLE, err)
+                return err
+            common.mkdir_if_not_exists(tmp_out)
+            if not self._az_client:
+                input_file = os.path.join(tmp_out, pkg_name + '.csv')
+                self._az_index.write_csv(apks, input_file)
+
         # Download the latest if SDK version is not given
         res, err = False, ''
-        if self._sdk_version is 'latest':
-            download_inner(apk_path)
-            res = True
+        downloaded_sdks = []
+        pending = [sdk for sdk in apk_paths if sdk != 'latest']
+        if 'latest' in apk_paths:
+            download_inner(apk_paths['latest'])
+            downloaded_sdks.append('latest')
+            if os.path.exists(apk_paths['latest']):
+                self._set_job_state(apk_paths['latest'], jl.DOWNLOADED)
+            else:
+                self._set_job_state(apk_paths['latest'], jl.FAILED,
+                                    "az did not download the app")
 
-        else:
+        downloaded = []
+        if pending and self._az_index:
+            # Download the versions most likely to target the first pending
+            # SDK version first, a few at a time, until all are found. A
+            # batch keeps every transfer of the native client busy.
+            batch_size = max(1, AS.CANDIDATE_BATCH, AS.NUM_DOWNLOADS
+                             if self._az_client else 1)
+            candidates = apks
+            while pending and candidates:
+                candidates = self._rank_az_candidates(candidates,
+                                                      int(pending[0]))
+                batch = candidates[:batch_size]
+                candidates = candidates[len(batch):]
+                batch_out = os.path.join(tmp_out, str(len(downloaded)))
+                common.mkdir_if_not_exists(batch_out)
+                download_inner(batch_out, batch)
+                new = glob.glob(os.path.join(batch_out, "**/*.apk"),
+                                recursive=True)
+                downloaded += new
+                check_apks(new)
+            msg = " - %d of %d versions have been downloaded." \
+                %(len(downloaded), len(apks))
+            self._logger.info(msg)
+        elif pending:
             # Create a temporary out directory to store downloaded apps
-            tmp_out = ".temp_out"
             common.mkdir_if_not_exists(tmp_out)
 
             # Download all app versions that are after targetted sdk release date
@@ -219,53 +853,76 @@ class Downloader:
             msg = " - %d different version apps have been downloaded." \
                 %(len(downloaded))
             self._logger.info(msg)
-            for apk in downloaded:
+            check_apks(downloaded)
 
-                # If target sdk version found, move the app to out_dir
-                min_sdk_app = aapt.get_min_sdk_version(apk)
-                tgt_sdk_app = aapt.get_tgt_sdk_version(apk)
-                if tgt_sdk_app == -1 or min_sdk_app == -1:
-                    err = " - SDK versions are not found in manifest " + \
-                            "(minSdkVersion or targetSdkVersion)."
-                    self._logger.debug(err)
-                    common.rm(apk)
-                    continue
+        # If az downloaded nothing, it failed rather than the app being
+        # unavailable for the SDK versions
+        for sdk_version in pending:
+            if downloaded:
+                self._set_job_state(apk_paths[sdk_version],
+                                    jl.UNAVAILABLE, "No version found")
+            else:
+                self._set_job_state(apk_paths[sdk_version], jl.FAILED,
+                                    "az did not download any version")
 
-                msg = "  - %s (minSdkVersion: %d, targetSdkVersion: %d)" \
-                    %(apk, min_sdk_app, tgt_sdk_app)
-                self._logger.debug(msg)
+        # Delete temporary directory containing downloaded apps
+        common.rm(tmp_out)
 
-                if self._check_sdk_version(target_sdk=int(self._sdk_version),
-                                           min_sdk_app=min_sdk_app,
-                                           tgt_sdk_app=tgt_sdk_app):
-                    command = ['mv', apk, apk_path]
-                    common.run_command(command)
-                    res = True
-                    break
+        for sdk_version in apk_paths:
+            msg = " - Found an app with the given SDK version." \
+                if sdk_version in downloaded_sdks else \
+                " - Couldn't find an app for any of the given SDK versions."
+            if len(apk_paths) > 1:
+                msg += " (sdk_version: %s)" % (sdk_version)
+            self._logger.info(msg)
+        res = len(downloaded_sdks) == len(apk_paths)
+        return None if res else err
 
-            # Delete temporary directory containing downloaded apps
-            common.rm(tmp_out)
+    def _rank_az_candidates(self, apks: list, sdk_version: int) -> list:
+        '''
+        Sort AndroZoo rows by how likely they target the given SDK version.
+        Versions built after the SDK's release come first, closest to
+        SDK_ADOPTION_DAYS after it, then versions built before the release,
+        and versions without a valid build date last.
+        '''
+        known = [sdk for sdk in cfg.SDK_VERSION_DATE if sdk <= sdk_version]
+        release = self._to_date(cfg.SDK_VERSION_DATE[
+            max(known) if known else min(cfg.SDK_VERSION_DATE)])
+        pivot = release + timedelta(days=AS.SDK_ADOPTION_DAYS)
 
-        msg = " - Found an app with the given SDK version." if res else \
-            " - Couldn't find an app for any of the given SDK versions."
-        self._logger.info(msg)
-        return None if res else err
+        def key(apk: dict) -> tuple:
+            date = self._to_date(apk['dex_date'])
+            if date is None:
+                return (2, 0, -(apk['vercode'] or 0))
+            return (int(date < release), abs((date - pivot).days),
+                    -(apk['vercode'] or 0))
+        return sorted(apks, key=key)
 
-    def _prep_out_path(self, out_path: str, cat: str, pkg_name: str) -> bool:
+    def _set_job_state(self, apk_path: str, state: str, reason: str = None,
+                       vc: int = None) -> None:
+        '''
+        Record the state of the job of the given APK path in the job ledger
+        '''
+        if self._job_ledger:
+            reason = reason.strip(' -') if reason else reason
+            self._job_ledger.set_state(apk_path, state, reason, vc)
+
+    def _prep_out_path(self, out_path: str, cat: str, pkg_name: str,
+                       sdk_version: str) -> bool:
         '''
         Prepare output path 
         '''
         downloaded = False
-        out_path_sdk = os.path.join(out_path, self._sdk_version)
-        if self._sdk_version_match and self._sdk_version != 'latest':
+        out_path_sdk = os.path.join(out_path, sdk_version)
+        if self._sdk_version_match and sdk_version != 'latest':
             out_path_sdk += '_match'
         out_path_cat = os.path.join(out_path_sdk, cat)
         out_path_pkg = os.path.join(out_path_cat, pkg_name + '.apk')
         common.mkdir_if_not_exists(out_path_sdk)
         common.mkdir_if_not_exists(out_path_cat)
         if os.path.exists(out_path_pkg):
-            self._logger.info('Skip for already downloaded app: %s' %
-                              (pkg_name))
+            self._logger.info('Skip for already downloaded app: %s (%s)' %
+                              (pkg_name, sdk_version))
             downloaded = True
         return downloaded
 
@@ -278,20 +935,38 @@ class Downloader:
         if not res:
             sys.exit("Given mode is not valid: %s" % (self.mode))
 
-    def _check_env_for_mode(self) -> None:
+    def _check_env_for_mode(self, accounts: list = None) -> None:
         '''
         Check environment variables
         '''
         if self._mode == Downloader.MODE_GPAPI:
             envs = \
                 [GPAPI_C.EMAIL, GPAPI_C.PASSWORD, GPAPI_C.GSFID, GPAPI_C.TOKEN]
-            res = all([True if v in os.environ else False for v in envs])
+            res = all([True if v in os.environ else False for v in envs]) \
+                or bool(accounts) or GPAPI_C.ACCOUNTS in os.environ
         elif self._mode == Downloader.MODE_AZ:
             envs = [AZ_C.API_KEY, AZ_C.INPUT_FILE]
             res = all([True if v in os.environ else False for v in envs])
         if not res:
             sys.exit("Please set global variables for:\n - " + str(envs))
 
+    def _get_credentials(self, accounts: list = None) -> list:
+        '''
+        (email, password) of the given accounts, the accounts in the file of
+        GPAPI_ACCOUNTS, or the account in GPAPI_EMAIL and GPAPI_PASSWORD
+        '''
+        if accounts:
+            return [tuple(a) for a in accounts]
+        if GPAPI_C.ACCOUNTS in os.environ:
+            credentials = []
+            with open(os.environ[GPAPI_C.ACCOUNTS], 'r') as f:
+                for line in f.readlines():
+                    splitted = line.strip().split(',')
+                    if len(splitted) >= 2:
+                        credentials.append((splitted[0], splitted[1]))
+            return credentials
+        return [(os.environ[GPAPI_C.EMAIL], os.environ[GPAPI_C.PASSWORD])]
+
     def _check_sdk_version(self, target_sdk: int, min_sdk_app: int,
                            tgt_sdk_app: int) -> bool:
         '''
@@ -304,33 +979,277 @@ class Downloader:
 
     def _write_apk(self, fl: dict, apk_path: str) -> None:
         '''
-        Write downloaded apk file
+        Write downloaded apk file. It is written to a temporary path and then
+        renamed, so that a partial APK is never left at 'apk_path'.
+        '''
+        tmp_path = apk_path + '.part'
+        try:
+            with open(tmp_path, "wb") as apk_file:
+                for chunk in fl.get("file").get("data"):
+                    apk_file.write(chunk)
+            os.replace(tmp_path, apk_path)
+        finally:
+            common.rm(tmp_path)
+
+    def _buffer_apk(self, fl: dict, spill_dir: str = None,
+                    accept: Callable[[dict], bool] = None,
+                    cancel: threading.Event = None) \
+            -> Tuple[IO[bytes], dict]:
+        '''
+        Download apk file into memory. An APK larger than PROBE_BUFFER_SIZE
+        spills into an unnamed temporary file in 'spill_dir'. If 'accept' is
+        given, the manifest is decoded as soon as it arrives, and the
+        download is aborted if accept(manifest) is False, or once 'cancel'
+        is set.
+        Returns (buffer or None if aborted, manifest or None if not decoded)
         '''
-        with open(apk_path, "wb") as apk_file:
+        if spill_dir:
+            common.mkdir_if_not_exists(spill_dir)
+        buffer = tempfile.SpooledTemporaryFile(max_size=cfg.PROBE_BUFFER_SIZE,
+                                               dir=spill_dir)
+        reader = LocalEntryReader(axml.MANIFEST) \
+            if accept and cfg.ENABLE_STREAM_PROBE else None
+        manifest = None
+        try:
             for chunk in fl.get("file").get("data"):
-                apk_file.write(chunk)
+                if cancel is not None and cancel.is_set():
+                    buffer.close()
+                    if fl.get("file").get("close"):
+                        fl.get("file").get("close")()
+                    return None, None
+                buffer.write(chunk)
+                entry = reader.feed(chunk) if reader else None
+                if entry is None:
+                    continue
+                try:
+                    manifest = axml.decode_manifest(entry)
+                except axml.AxmlError:
+                    continue
+                if not accept(manifest):
+                    self._logger.debug(' - Stream probe: rejected after %d '
+                                       'of %s bytes' % (buffer.tell(),
+                                       fl.get("file").get("total_size")))
+                    buffer.close()
+                    if fl.get("file").get("close"):
+                        fl.get("file").get("close")()
+                    return None, manifest
+        except BaseException:
+            buffer.close()
+            raise
+        return buffer, manifest
+
+    def _save_apk(self, buffer: IO[bytes], apk_path: str) -> None:
+        '''
+        Write a buffered apk file atomically, like _write_apk()
+        '''
+        tmp_path = apk_path + '.part'
+        try:
+            buffer.seek(0)
+            with open(tmp_path, "wb") as apk_file:
+                shutil.copyfileobj(buffer, apk_file)
+            os.replace(tmp_path, apk_path)
+        finally:
+            common.rm(tmp_path)
+
+    def _move_apk(self, src_path: str, apk_path: str) -> None:
+        '''
+        Move an apk file atomically, copying it if 'src_path' is on another
+        file system
+        '''
+        try:
+            os.replace(src_path, apk_path)
+        except OSError:
+            with open(src_path, "rb") as src:
+                self._save_apk(src, apk_path)
+            common.rm(src_path)
+
+    def _read_remote_manifest(self, fl: dict,
+                              cancel: threading.Event = None) \
+            -> Tuple[dict, int]:
+        '''
+        Read the manifest of a delivered (but not fetched) APK with HTTP
+        Range requests. Returns (None, -1) if the server doesn't allow it,
+        and hosts which ignored a Range request once are not tried again.
+        No more requests are made once 'cancel' is set.
+        '''
+        host = urlparse(fl.get('url')).netloc
+        if host in self._no_range_hosts:
+            return None, -1
+
+        def fetch_range(start: int, length: int) -> Tuple[bytes, int]:
+            if cancel is not None and cancel.is_set():
+                raise RemoteZipError("Range probe is cancelled")
+            return self._call_gpapi('fetchRange', fl.get('url'),
+                                    fl.get('cookies'), start, length)
+
+        remote_zip = RemoteZip(fetch_range)
+        try:
+            manifest = remote_zip.read_manifest()
+        except RangeNotSupportedError as e:
+            self._no_range_hosts.add(host)
+            self._logger.info(' - Range probe is disabled for %s. %s' %
+                              (host, e))
+            return None, -1
+        except Exception as e:
+            self._logger.debug(' - Range probe failed. %s' % (e))
+            return None, -1
+        self._logger.debug(' - Range probe: %d bytes in %d requests' %
+                           (remote_zip.bytes_fetched, remote_zip.num_requests))
+        return manifest, remote_zip.total_size
+
+    def _log_gpapi_stats(self) -> None:
+        '''
+        Log request latency per endpoint and the number of connections
+        opened, i.e., handshakes paid, for all Google Play API requests
+        '''
+        endpoints, num_connections = {}, 0
+        for account in self._accounts.accounts:
+            stats = account.server.getLatencyStats()
+            num_connections += stats['connections']
+            for endpoint, v in stats['endpoints'].items():
+                total = endpoints.setdefault(endpoint,
+                                             {'requests': 0, 'time': 0})
+                total['requests'] += v['requests']
+                total['time'] += v['time']
+        num_requests = 0
+        for endpoint, v in sorted(endpoints.items()):
+            num_requests += v['requests']
+            self._logger.debug(' - %s: %d requests, %.3fs on average' %
+                               (endpoint, v['requests'],
+                                v['time'] / v['requests']))
+        self._logger.info("GPAPI: %d requests over %d connections" %
+                          (num_requests, num_connections))
+        if len(self._accounts) > 1:
+            for v in self._accounts.get_stats():
+                self._logger.info(' - %s: %d requests, %d busy, health %.2f'
+                                  % (v['email'], v['requests'], v['busy'],
+                                     v['health']))
+
+    def _login_gpapi(self, use_stored: bool = True) -> None:
+        '''
+        Login to Google Play API server with all the accounts. Accounts
+        failed to login are not used.
+        '''
+        error = None
+        for account in self._accounts.accounts:
+            try:
+                self._login_account(account, use_stored)
+            except Exception as e:
+                self._logger.warning("Google Play login failed (%s). %s" %
+                                     (account.email, e))
+                error = e
+        if not [a for a in self._accounts.accounts if a.logged_in]:
+            if error: raise error
+            sys.exit("No Google account is given")
 
-    def _login_gpapi(self):
+    def _login_account(self, account: Account,
+                       use_stored: bool = True) -> None:
         '''
-        Login to Google Play API server
+        Login to Google Play API server with the given account
+        - If 'use_stored', try the stored session first, which only needs
+          a single request to validate
         '''
+        store = None
+        if GS.ENABLE_SESSION_STORE:
+            store = SessionStore(
+                SessionStore.get_path(cfg.SESSION_DIR, account.email),
+                account.password)
+        session = store.load() if store and use_stored else None
+        if session:
+            account.server.restoreSession(session)
+            try:
+                account.server.validateSession()
+                account.logged_in = True
+                self._logger.info("Google Play login successful " +
+                                  "(stored session)")
+                return
+            except Exception as e:
+                self._logger.info("Stored session is not valid. %s" % (e))
+
         #            self._server.login(email=os.environ[GPAPI_C.EMAIL],
         #                               password=os.environ[GPAPI_C.PASSWORD],
         #                               gsfId=os.environ[GPAPI_C.GSFID],
         #                               authSubToken=os.environ[GPAPI_C.TOKEN])
-        self._gpapi_server.login(email=os.environ[GPAPI_C.EMAIL],
-                                 password=os.environ[GPAPI_C.PASSWORD],
-                                 gsfId=None,
-                                 authSubToken=None)
+        account.server.login(email=account.email,
+                             password=account.password,
+                             gsfId=None,
+                             authSubToken=None)
+        account.logged_in = True
+        if store: store.save(account.server.getSession())
 
         self._logger.info("Google Play login successful")
 
-    def _get_apk_path(self, out_path: str, cat: str, pkg_name: str) -> str:
+    def _call_gpapi(self, method: str, *args, **kwargs):
+        '''
+        Call the given GooglePlayAPI method with the least-loaded healthy
+        account. If the server is busy for the account, try other accounts.
+        '''
+        tried = []
+        while True:
+            account = self._accounts.acquire(exclude=tried)
+            busy, failed = False, False
+            try:
+                return self._call_account(account, method, *args, **kwargs)
+            except RequestError as e:
+                busy = "busy" in str(e).lower()
+                if busy and len(tried) + 1 < len(self._accounts):
+                    tried.append(account)
+                    continue
+                raise
+            except Exception:
+                failed = True
+                raise
+            finally:
+                self._accounts.release(account, busy=busy, failed=failed)
+
+    def _call_account(self, account: Account, method: str, *args, **kwargs):
+        '''
+        Call the given GooglePlayAPI method of the account, and login again
+        once if the session turns out to be invalid
+        '''
+        token = account.server.authSubToken
+        try:
+            return getattr(account.server, method)(*args, **kwargs)
+        except LoginError as e:
+            with account.login_lock:
+                # Another worker may have already logged in again
+                if account.server.authSubToken == token:
+                    self._logger.info("Session expired. %s" % (e))
+                    self._login_account(account, use_stored=False)
+            return getattr(account.server, method)(*args, **kwargs)
+
+    def _get_apk_path(self, out_path: str, cat: str, pkg_name: str,
+                      sdk_version: str) -> str:
         '''
-        Get APK path for the given category and package name 
+        Get APK path for the given category, package name and SDK version
         '''
-        sdk_path = os.path.join(out_path, self._sdk_version)
-        if self._sdk_version_match and self._sdk_version != 'latest':
+        sdk_path = os.path.join(out_path, sdk_version)
+        if self._sdk_version_match and sdk_version != 'latest':
             sdk_path += '_match'
         apk_path = os.path.join(sdk_path, cat, pkg_name + '.apk')
         return apk_path
+
+    @staticmethod
+    def _to_date(date: str) -> datetime:
+        '''
+        Date of a dex_date of AndroZoo, or None if invalid (e.g., 1980-00-00,
+        or before the first Android release)
+        '''
+        try:
+            date = datetime.strptime((date or '')[:10], '%Y-%m-%d')
+        except ValueError:
+            return None
+        return date if date >= datetime(2008, 9, 23) else None
+
+    @staticmethod
+    def _to_sdk_versions(sdk_version) -> list:
+        '''
+        Normalize a SDK version or a collection of them to a sorted list of
+        strings. 'latest' stands for no SDK version.
+        '''
+        if not sdk_version:
+            return ['latest']
+        if isinstance(sdk_version, (list, tuple, set, frozenset)):
+            versions = set([str(v) if v else 'latest' for v in sdk_version])
+            return sorted(versions, key=lambda v: (v == 'latest', v.zfill(3)))
+        return [str(sdk_version)]
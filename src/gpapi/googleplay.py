@@ -9,7 +9,12 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.serialization import load_der_public_key
 from cryptography.hazmat.primitives.asymmetric import padding
 
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from . import googleplay_pb2, config, utils
 
@@ -55,6 +60,11 @@ class RequestError(Exception):
         return repr(self.value)
 
 
+class RangeNotSupportedError(RequestError):
+    """The server ignored the Range header of *fetchRange*"""
+    pass
+
+
 class SecurityCheckError(Exception):
     def __init__(self, value):
         self.value = value
@@ -72,13 +82,22 @@ class GooglePlayAPI(object):
                  locale="en_US",
                  timezone="UTC",
                  device_codename="bacon",
-                 proxies_config=None):
+                 proxies_config=None,
+                 rate_limiter=None,
+                 pool_connections=10,
+                 pool_maxsize=10,
+                 max_retries=3):
         self.authSubToken = None
         self.gsfId = None
         self.device_config_token = None
         self.deviceCheckinConsistencyToken = None
         self.dfeCookie = None
         self.proxies_config = proxies_config
+        self.rate_limiter = rate_limiter
+        self.session = self._createSession(pool_connections, pool_maxsize,
+                                           max_retries)
+        self.latency = {}
+        self.latencyLock = threading.Lock()
         self.deviceBuilder = config.DeviceBuilder(device_codename)
         self.setLocale(locale)
         self.setTimezone(timezone)
@@ -89,6 +108,85 @@ class GooglePlayAPI(object):
     def setTimezone(self, timezone):
         self.deviceBuilder.setTimezone(timezone)
 
+    @staticmethod
+    def _createSession(pool_connections, pool_maxsize, max_retries):
+        """Create a session which keeps connections alive, so that requests
+        don't pay a new TCP and TLS handshake each time. The session is
+        shared by all threads using this object.
+
+        Args:
+            pool_connections (int): number of hosts to keep pools for
+            pool_maxsize (int): connections kept alive per host, which should
+                be at least the number of threads sending requests
+            max_retries (int): retries on connection errors and HTTP
+                500/502/504 (429/503 are left to the rate limiter)"""
+        retry = Retry(total=max_retries,
+                      backoff_factor=0.5,
+                      status_forcelist=(500, 502, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def getLatencyStats(self):
+        """Return the number of requests, the total and average latency
+        (seconds) of each endpoint, and the number of connections opened,
+        which shows how many handshakes the connection pool saved"""
+        with self.latencyLock:
+            stats = {k: dict(v) for k, v in self.latency.items()}
+        for v in stats.values():
+            v['average'] = v['time'] / v['requests'] if v['requests'] else 0
+        connections = 0
+        for adapter in set(self.session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                connections += getattr(pool, 'num_connections', 0)
+        return {'endpoints': stats, 'connections': connections}
+
+    def _request(self, method, url, **kwargs):
+        """Send a request through the rate limiter (if any) and report
+        throttled responses (HTTP 429/503) back to it"""
+        endpoint = utils.getEndpoint(url)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(endpoint)
+        start = time.monotonic()
+        response = self.session.request(method,
+                                        url,
+                                        verify=ssl_verify,
+                                        proxies=self.proxies_config,
+                                        **kwargs)
+        self._recordLatency(endpoint, time.monotonic() - start)
+        if self.rate_limiter is not None:
+            if response.status_code in (429, 503):
+                self.rate_limiter.on_throttled(endpoint)
+            else:
+                self.rate_limiter.on_success(endpoint)
+        return response
+
+    def _recordLatency(self, endpoint, elapsed):
+        # Time to the response headers
+        with self.latencyLock:
+            if endpoint not in self.latency:
+                self.latency[endpoint] = {'requests': 0, 'time': 0.0}
+            self.latency[endpoint]['requests'] += 1
+            self.latency[endpoint]['time'] += elapsed
+
+    def _checkAuth(self, response):
+        """Raise LoginError if the session is not (or no longer) valid"""
+        if response.status_code == 401:
+            raise LoginError("Authentication failed (HTTP 401)")
+
+    def _raiseRequestError(self, url, message):
+        """Raise RequestError for the error message from the server, letting
+        the rate limiter back off if the server is busy"""
+        if self.rate_limiter is not None and "busy" in message.lower():
+            self.rate_limiter.on_throttled(utils.getEndpoint(url))
+        raise RequestError(message)
+
     def encryptPassword(self, login, passwd):
         """Encrypt credentials using the google publickey, with the
         RSA algorithm"""
@@ -159,11 +257,9 @@ class GooglePlayAPI(object):
         request = self.deviceBuilder.getAndroidCheckinRequest()
 
         stringRequest = request.SerializeToString()
-        res = requests.post(CHECKIN_URL,
+        res = self._request("POST", CHECKIN_URL,
                             data=stringRequest,
-                            headers=headers,
-                            verify=ssl_verify,
-                            proxies=self.proxies_config)
+                            headers=headers)
         response = googleplay_pb2.AndroidCheckinResponse()
         response.ParseFromString(res.content)
         self.deviceCheckinConsistencyToken = response.deviceCheckinConsistencyToken
@@ -174,11 +270,9 @@ class GooglePlayAPI(object):
         request.accountCookie.append("[" + email + "]")
         request.accountCookie.append(ac2dmToken)
         stringRequest = request.SerializeToString()
-        requests.post(CHECKIN_URL,
+        self._request("POST", CHECKIN_URL,
                       data=stringRequest,
-                      headers=headers,
-                      verify=ssl_verify,
-                      proxies=self.proxies_config)
+                      headers=headers)
 
         return response.androidId
 
@@ -191,12 +285,10 @@ class GooglePlayAPI(object):
             self.deviceBuilder.getDeviceConfig())
         headers = self.getHeaders(upload_fields=True)
         stringRequest = upload.SerializeToString()
-        response = requests.post(UPLOAD_URL,
+        response = self._request("POST", UPLOAD_URL,
                                  data=stringRequest,
                                  headers=headers,
-                                 verify=ssl_verify,
-                                 timeout=60,
-                                 proxies=self.proxies_config)
+                                 timeout=60)
         response = googleplay_pb2.ResponseWrapper.FromString(response.content)
         try:
             if response.payload.HasField('uploadDeviceConfigResponse'):
@@ -226,10 +318,8 @@ class GooglePlayAPI(object):
             params['callerPkg'] = 'com.google.android.gms'
             headers = self.deviceBuilder.getAuthHeaders(self.gsfId)
             headers['app'] = 'com.google.android.gsm'
-            response = requests.post(AUTH_URL,
-                                     data=params,
-                                     verify=ssl_verify,
-                                     proxies=self.proxies_config)
+            response = self._request("POST", AUTH_URL,
+                                     data=params)
             data = response.text.split()
             params = {}
             for d in data:
@@ -262,17 +352,44 @@ class GooglePlayAPI(object):
             raise LoginError(
                 'Either (email,pass) or (gsfId, authSubToken) is needed')
 
+    def getSession(self):
+        """Return the state of a logged in session, which can be stored and
+        given to *restoreSession* later instead of logging in again"""
+        return {
+            'gsfId': self.gsfId,
+            'authSubToken': self.authSubToken,
+            'device_config_token': self.device_config_token,
+            'deviceCheckinConsistencyToken':
+            self.deviceCheckinConsistencyToken,
+            'dfeCookie': self.dfeCookie
+        }
+
+    def restoreSession(self, session):
+        """Restore a session returned by *getSession*. Use *validateSession*
+        to check whether it is still valid."""
+        self.gsfId = session.get('gsfId')
+        self.authSubToken = session.get('authSubToken')
+        self.device_config_token = session.get('device_config_token')
+        self.deviceCheckinConsistencyToken = session.get(
+            'deviceCheckinConsistencyToken')
+        self.dfeCookie = session.get('dfeCookie')
+
+    def validateSession(self):
+        """Check the session with a single cheap request. Raises LoginError
+        if the session is not valid."""
+        if self.gsfId is None or self.authSubToken is None:
+            raise LoginError("No session to validate")
+        self.executeRequestApi2(TOC_URL)
+
     def getAuthSubToken(self, email, passwd):
         requestParams = self.deviceBuilder.getLoginParams(email, passwd)
         requestParams['service'] = 'androidmarket'
         requestParams['app'] = 'com.android.vending'
         headers = self.deviceBuilder.getAuthHeaders(self.gsfId)
         headers['app'] = 'com.android.vending'
-        response = requests.post(AUTH_URL,
+        response = self._request("POST", AUTH_URL,
                                  data=requestParams,
-                                 verify=ssl_verify,
-                                 headers=headers,
-                                 proxies=self.proxies_config)
+                                 headers=headers)
         data = response.text.split()
         params = {}
         for d in data:
@@ -302,11 +419,9 @@ class GooglePlayAPI(object):
         params.pop('EncryptedPasswd')
         headers = self.deviceBuilder.getAuthHeaders(self.gsfId)
         headers['app'] = 'com.android.vending'
-        response = requests.post(AUTH_URL,
+        response = self._request("POST", AUTH_URL,
                                  data=params,
-                                 headers=headers,
-                                 verify=ssl_verify,
-                                 proxies=self.proxies_config)
+                                 headers=headers)
         data = response.text.split()
         params = {}
         for d in data:
@@ -332,24 +447,24 @@ class GooglePlayAPI(object):
         headers["Content-Type"] = content_type
 
         if post_data is not None:
-            response = requests.post(path,
-                                     data=str(post_data),
+            # Serialized protobuf bodies are sent as they are
+            if not isinstance(post_data, bytes):
+                post_data = str(post_data)
+            response = self._request("POST", path,
+                                     data=post_data,
                                      headers=headers,
                                      params=params,
-                                     verify=ssl_verify,
-                                     timeout=60,
-                                     proxies=self.proxies_config)
+                                     timeout=60)
         else:
-            response = requests.get(path,
-                                    headers=headers,
-                                    params=params,
-                                    verify=ssl_verify,
-                                    timeout=60,
-                                    proxies=self.proxies_config)
+            response = self._request("GET", path,
+                                     headers=headers,
+                                     params=params,
+                                     timeout=60)
 
+        self._checkAuth(response)
         message = googleplay_pb2.ResponseWrapper.FromString(response.content)
         if message.commands.displayErrorMessage != "":
-            raise RequestError(message.commands.displayErrorMessage)
+            self._raiseRequestError(path, message.commands.displayErrorMessage)
 
         return message
 
@@ -408,20 +523,42 @@ class GooglePlayAPI(object):
             a list of dictionaries containing docv2 data, or None
             if the app doesn't exist"""
 
+        return [
+            None
+            if not utils.hasDoc(entry) else utils.parseProtobufObj(entry.doc)
+            for entry in self._bulkDetailsEntries(packageNames)
+        ]
+
+    def bulkAppDetails(self, packageNames):
+        """Get the latest version of several apps in one request, without
+        converting the whole documents to dictionaries like bulkDetails().
+
+        Returns:
+            a dictionary of package names to dictionaries with versionCode,
+            installationSize and uploadDate, or None if the app doesn't
+            exist"""
+        result = {packageName: None for packageName in packageNames}
+        for entry in self._bulkDetailsEntries(packageNames):
+            if not utils.hasDoc(entry):
+                continue
+            appDetails = entry.doc.details.appDetails
+            result[entry.doc.docid] = {
+                'versionCode': appDetails.versionCode,
+                'installationSize': appDetails.installationSize,
+                'uploadDate': appDetails.uploadDate
+            }
+        return result
+
+    def _bulkDetailsEntries(self, packageNames):
         params = {'au': '1'}
         req = googleplay_pb2.BulkDetailsRequest()
         req.docid.extend(packageNames)
         data = req.SerializeToString()
         message = self.executeRequestApi2(BULK_URL,
-                                          post_data=data.decode("utf-8"),
+                                          post_data=data,
                                           content_type=CONTENT_TYPE_PROTO,
                                           params=params)
-        response = message.payload.bulkDetailsResponse
-        return [
-            None
-            if not utils.hasDoc(entry) else utils.parseProtobufObj(entry.doc)
-            for entry in response.entry
-        ]
+        return message.payload.bulkDetailsResponse.entry
 
     def home(self, cat=None):
         path = HOME_URL + "?c=3&nocache_isui=true"
@@ -524,27 +661,63 @@ class GooglePlayAPI(object):
 
     def _deliver_data(self, url, cookies):
         headers = self.getHeaders()
-        response = requests.get(url,
-                                headers=headers,
-                                cookies=cookies,
-                                verify=ssl_verify,
-                                stream=True,
-                                timeout=60,
-                                proxies=self.proxies_config)
+        response = self._request("GET", url,
+                                 headers=headers,
+                                 cookies=cookies,
+                                 stream=True,
+                                 timeout=60)
         total_size = response.headers.get('content-length')
         chunk_size = 32 * (1 << 10)
         return {
             'data': response.iter_content(chunk_size=chunk_size),
             'total_size': total_size,
-            'chunk_size': chunk_size
+            'chunk_size': chunk_size,
+            'close': response.close
         }
 
+    def fetchFile(self, url, cookies):
+        """Start downloading a file returned by *delivery* with
+        fetch_data=False, e.g., after *fetchRange* failed.
+
+        Returns:
+            the same dictionary as 'file' of *delivery* with fetch_data"""
+        return self._deliver_data(url, cookies)
+
+    def fetchRange(self, url, cookies, start, length):
+        """Fetch a byte range of a file returned by *delivery* with
+        fetch_data=False. A negative start means the last -start bytes.
+
+        Returns:
+            a tuple of the data and the total size of the file"""
+        if start < 0:
+            byte_range = "bytes=-{}".format(-start)
+        else:
+            byte_range = "bytes={}-{}".format(start, start + length - 1)
+        headers = self.getHeaders()
+        headers["Range"] = byte_range
+        response = self._request("GET", url,
+                                 headers=headers,
+                                 cookies=cookies,
+                                 stream=True,
+                                 timeout=60)
+        if response.status_code != 206:
+            # Don't download the whole file if the server ignored the range
+            response.close()
+            raise RangeNotSupportedError(
+                "Range request is not supported (status: {})"
+                .format(response.status_code))
+        content_range = response.headers.get('content-range', '')
+        total_size = content_range.rsplit('/', 1)[-1]
+        total_size = int(total_size) if total_size.isdigit() else None
+        return response.content, total_size
+
     def delivery(self,
                  packageName,
                  versionCode=None,
                  offerType=1,
                  downloadToken=None,
-                 expansion_files=False):
+                 expansion_files=False,
+                 fetch_data=True):
         """Download an already purchased app.
 
         Args:
@@ -553,6 +726,9 @@ class GooglePlayAPI(object):
             offerType (int): different type of downloads (mostly unused for apks)
             downloadToken (str): download token returned by 'purchase' API
             progress_bar (bool): wether or not to print a progress bar to stdout
+            fetch_data (bool): if False, do not start downloading and return
+                'url' and 'cookies' of each file instead of its data (see
+                *fetchRange*)
 
         Returns:
             Dictionary containing apk data and a list of expansion files. As stated
@@ -580,15 +756,15 @@ class GooglePlayAPI(object):
         headers = self.getHeaders()
         if downloadToken is not None:
             params['dtok'] = downloadToken
-        response = requests.get(DELIVERY_URL,
-                                headers=headers,
-                                params=params,
-                                verify=ssl_verify,
-                                timeout=60,
-                                proxies=self.proxies_config)
+        response = self._request("GET", DELIVERY_URL,
+                                 headers=headers,
+                                 params=params,
+                                 timeout=60)
+        self._checkAuth(response)
         response = googleplay_pb2.ResponseWrapper.FromString(response.content)
         if response.commands.displayErrorMessage != "":
-            raise RequestError(response.commands.displayErrorMessage)
+            self._raiseRequestError(DELIVERY_URL,
+                                    response.commands.displayErrorMessage)
         elif response.payload.deliveryResponse.appDeliveryData.downloadUrl == "":
             raise RequestError('App not purchased')
         else:
@@ -600,12 +776,18 @@ class GooglePlayAPI(object):
             cookie = response.payload.deliveryResponse.appDeliveryData.downloadAuthCookie[
                 0]
             cookies = {str(cookie.name): str(cookie.value)}
-            result['file'] = self._deliver_data(downloadUrl, cookies)
+            if fetch_data:
+                result['file'] = self._deliver_data(downloadUrl, cookies)
+            else:
+                result['file'] = {'url': downloadUrl, 'cookies': cookies}
 
             for split in response.payload.deliveryResponse.appDeliveryData.split:
                 a = {}
                 a['name'] = split.name
-                a['file'] = self._deliver_data(split.downloadUrl, None)
+                if fetch_data:
+                    a['file'] = self._deliver_data(split.downloadUrl, None)
+                else:
+                    a['file'] = {'url': split.downloadUrl, 'cookies': None}
                 result['splits'].append(a)
 
             if not expansion_files:
@@ -620,7 +802,10 @@ class GooglePlayAPI(object):
                     obbType = 'patch'
                 a['type'] = obbType
                 a['versionCode'] = obb.versionCode
-                a['file'] = self._deliver_data(obb.downloadUrl, None)
+                if fetch_data:
+                    a['file'] = self._deliver_data(obb.downloadUrl, None)
+                else:
+                    a['file'] = {'url': obb.downloadUrl, 'cookies': None}
                 result['additionalData'].append(a)
             return result
 
@@ -628,7 +813,8 @@ class GooglePlayAPI(object):
                  packageName,
                  versionCode=None,
                  offerType=1,
-                 expansion_files=False):
+                 expansion_files=False,
+                 fetch_data=True):
         """Download an app and return its raw data (APK file). Free apps need
         to be "purchased" first, in order to retrieve the download cookie.
         If you want to download an already purchased app, use *delivery* method.
@@ -639,6 +825,7 @@ class GooglePlayAPI(object):
             offerType (int): different type of downloads (mostly unused for apks)
             downloadToken (str): download token returned by 'purchase' API
             progress_bar (bool): wether or not to print a progress bar to stdout
+            fetch_data (bool): see *delivery*
 
         Returns
             Dictionary containing apk data and optional expansion files
@@ -661,23 +848,24 @@ class GooglePlayAPI(object):
             'vc': str(versionCode)
         }
         #        self.log(packageName)
-        response = requests.post(PURCHASE_URL,
+        response = self._request("POST", PURCHASE_URL,
                                  headers=headers,
                                  params=params,
-                                 verify=ssl_verify,
-                                 timeout=60,
-                                 proxies=self.proxies_config)
+                                 timeout=60)
 
+        self._checkAuth(response)
         response = googleplay_pb2.ResponseWrapper.FromString(response.content)
         if response.commands.displayErrorMessage != "":
-            raise RequestError(response.commands.displayErrorMessage)
+            self._raiseRequestError(PURCHASE_URL,
+                                    response.commands.displayErrorMessage)
         else:
             dlToken = response.payload.buyResponse.downloadToken
             return self.delivery(packageName,
                                  versionCode,
                                  offerType,
                                  dlToken,
-                                 expansion_files=expansion_files)
+                                 expansion_files=expansion_files,
+                                 fetch_data=fetch_data)
 
     def log(self, docid):
         log_request = googleplay_pb2.LogRequest()
@@ -686,22 +874,19 @@ class GooglePlayAPI(object):
         log_request.timestamp = timestamp
 
         string_request = log_request.SerializeToString()
-        response = requests.post(LOG_URL,
+        response = self._request("POST", LOG_URL,
                                  data=string_request,
                                  headers=self.getHeaders(),
-                                 verify=ssl_verify,
-                                 timeout=60,
-                                 proxies=self.proxies_config)
+                                 timeout=60)
         response = googleplay_pb2.ResponseWrapper.FromString(response.content)
         if response.commands.displayErrorMessage != "":
-            raise RequestError(response.commands.displayErrorMessage)
+            self._raiseRequestError(LOG_URL,
+                                    response.commands.displayErrorMessage)
 
     def toc(self):
-        response = requests.get(TOC_URL,
-                                headers=self.getHeaders(),
-                                verify=ssl_verify,
-                                timeout=60,
-                                proxies=self.proxies_config)
+        response = self._request("GET", TOC_URL,
+                                 headers=self.getHeaders(),
+                                 timeout=60)
         data = googleplay_pb2.ResponseWrapper.FromString(response.content)
         tocResponse = data.payload.tocResponse
         if utils.hasTosContent(tocResponse) and utils.hasTosToken(tocResponse):
@@ -712,12 +897,10 @@ class GooglePlayAPI(object):
 
     def acceptTos(self, tosToken):
         params = {"tost": tosToken, "toscme": "false"}
-        response = requests.get(ACCEPT_TOS_URL,
-                                headers=self.getHeaders(),
-                                params=params,
-                                verify=ssl_verify,
-                                timeout=60,
-                                proxies=self.proxies_config)
+        response = self._request("GET", ACCEPT_TOS_URL,
+                                 headers=self.getHeaders(),
+                                 params=params,
+                                 timeout=60)
         data = googleplay_pb2.ResponseWrapper.FromString(response.content)
         return utils.parseProtobufObj(data.payload.acceptTosResponse)
 
@@ -1,5 +1,6 @@
 import struct
 import sys
+from urllib.parse import urlparse
 from google.protobuf.message import Message
 from google.protobuf.json_format import MessageToDict
 from . import googleplay_pb2
@@ -9,6 +10,17 @@ def parseProtobufObj(obj):
     return MessageToDict(obj, False, False, False)
 
 
+def getEndpoint(url):
+    """Name of the endpoint of the given URL, e.g., 'details' for
+    https://android.clients.google.com/fdfe/details?doc=... or the host name
+    for APK downloads, which are served from separate hosts"""
+    parsed = urlparse(url)
+    path = parsed.path.rstrip('/')
+    if parsed.netloc == 'android.clients.google.com' and path:
+        return path.split('/')[-1]
+    return parsed.netloc
+
+
 def readInt(byteArray, start):
     """Read the byte array, starting from *start* position,
     as an 32-bit unsigned integer"""
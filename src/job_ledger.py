@@ -0,0 +1,130 @@
+#!/usr/bin/env python3.7
+'''
+@author: Chang Min Park (cpark22@buffalo.edu)
+'''
+
+import sqlite3
+import threading
+import time
+
+# Job States
+PENDING = 'pending'
+SEARCHING = 'searching'
+DOWNLOADED = 'downloaded'
+UNAVAILABLE = 'unavailable'
+FAILED = 'failed'
+
+# Bounds of the binary search of a job in the 'searching' state
+BOUNDS = ['l_vc', 'r_vc', 'l_vc_not_found', 'prev_vc']
+
+
+class JobLedger:
+    '''
+    On-disk ledger of download jobs of a download mode, one per target APK
+    path (package, SDK version and output directory), so that a restarted
+    run skips finished jobs and continues each search from its last bounds.
+    - pending: not started yet
+    - searching: search in progress with the bounds (l_vc, r_vc, ...),
+      continued from them on restart
+    - downloaded: the APK was written (with its version code)
+    - unavailable: no version for the SDK version, skipped on restart
+    - failed: interrupted by an error (with the reason), searched again
+      from scratch on restart
+    '''
+    def __init__(self, db_path: str, mode: str) -> None:
+        self._mode = mode
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    target TEXT NOT NULL,
+                    mode TEXT NOT NULL,
+                    pkg_name TEXT NOT NULL,
+                    sdk_version TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    l_vc INTEGER,
+                    r_vc INTEGER,
+                    l_vc_not_found INTEGER,
+                    prev_vc INTEGER,
+                    vc INTEGER,
+                    reason TEXT,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (target, mode)
+                )''')
+
+    def add(self, target: str, pkg_name: str, sdk_version: str) -> dict:
+        '''
+        Add a pending job for the given target unless it exists, and
+        return the job
+        '''
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR IGNORE INTO jobs (target, mode, pkg_name, '
+                'sdk_version, state, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                (target, self._mode, pkg_name, sdk_version, PENDING,
+                 time.time()))
+        return self.get(target)
+
+    def get(self, target: str) -> dict:
+        '''
+        Job of the given target, or None if there is none
+        '''
+        with self._lock:
+            cursor = self._conn.execute(
+                'SELECT * FROM jobs WHERE target = ? AND mode = ?',
+                (target, self._mode))
+            row = cursor.fetchone()
+            keys = [d[0] for d in cursor.description]
+        return None if row is None else dict(zip(keys, row))
+
+    def set_state(self, target: str, state: str, reason: str = None,
+                  vc: int = None) -> None:
+        '''
+        Change the state of the given job. Bounds of the search are cleared
+        once the search is over, since a failed search may have taken
+        versions that failed for a while (e.g., "busy") as unavailable.
+        '''
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE jobs SET state = ?, reason = ?, vc = ?, updated = ?, '
+                'l_vc = NULL, r_vc = NULL, l_vc_not_found = NULL, '
+                'prev_vc = NULL WHERE target = ? AND mode = ?',
+                (state, reason, vc, time.time(), target, self._mode))
+
+    def save_bounds(self, target: str, bounds: dict) -> None:
+        '''
+        Record the bounds of the search of the given job. Bounds must not
+        rest on versions that failed only for a while.
+        '''
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE jobs SET state = ?, l_vc = ?, r_vc = ?, '
+                'l_vc_not_found = ?, prev_vc = ?, reason = NULL, updated = ? '
+                'WHERE target = ? AND mode = ?',
+                tuple([SEARCHING] + [bounds.get(k) for k in BOUNDS] +
+                      [time.time(), target, self._mode]))
+
+    def get_bounds(self, target: str) -> dict:
+        '''
+        Bounds of the search of the given job interrupted in the 'searching'
+        state, or None if there is none
+        '''
+        job = self.get(target)
+        if job is None or job['state'] != SEARCHING or job['r_vc'] is None:
+            return None
+        return {k: job[k] for k in BOUNDS}
+
+    def get_summary(self) -> dict:
+        '''
+        Number of jobs in each state
+        '''
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT state, COUNT(*) FROM jobs WHERE mode = ? '
+                'GROUP BY state', (self._mode, )).fetchall()
+        return dict(rows)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
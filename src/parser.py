@@ -3,13 +3,65 @@
 @author: Chang Min Park (cpark22@buffalo.edu)
 '''
 import csv
+import collections.abc
+import heapq
+import io
+import itertools
+import multiprocessing
 import sys
 import os
 
 # Local package
 from src.config import APP_CATEGORY as CAT
+from src.column_store import ColumnStore, ColumnStoreError
+import src.column_store as cs
 import src.config as cfg
 
+# Size of blocks read to find record boundaries of a CSV file
+SPLIT_BLOCK_SIZE = 1 << 20
+
+
+class TopN:
+    '''
+    Bounded min-heap keeping the items with the 'limit' largest keys, or all
+    items if 'limit' is None. Memory is O(limit) regardless of the input.
+    '''
+    def __init__(self, limit: int = None) -> None:
+        self._limit = limit
+        self._heap = []
+
+    def push(self, key: tuple, item) -> None:
+        self._push((key, item))
+
+    def merge(self, entries: list) -> None:
+        '''
+        Push the (key, item) pairs of another's entries() without copying them
+        '''
+        for entry in entries:
+            self._push(entry)
+
+    def entries(self) -> list:
+        '''
+        (key, item) pairs in no particular order, e.g., to merge into another
+        '''
+        return list(self._heap)
+
+    def get(self) -> list:
+        '''
+        Items in descending order of their keys
+        '''
+        return [item for key, item in
+                sorted(self._heap, key=lambda e: e[0], reverse=True)]
+
+    # ----------------- #
+    #   Local Methods   #
+    # ----------------- #
+    def _push(self, entry: tuple) -> None:
+        if self._limit is None or len(self._heap) < self._limit:
+            heapq.heappush(self._heap, entry)
+        elif self._heap and entry[0] > self._heap[0][0]:
+            heapq.heapreplace(self._heap, entry)
+
 
 class AppDataParser:
     ''' 
@@ -28,15 +80,45 @@ class AppDataParser:
     FREE = "Free"
     INSTALLS = "Installs"
 
+    '''
+    Typed columns of the cache in addition to the parsed ones
+    '''
+    global RATING_VALUE, SIZE_BYTES, RELEASE_DATE, CACHE_COLUMNS
+    RATING_VALUE = "rating_value"  # NaN if unknown
+    SIZE_BYTES = "size_bytes"  # -1 if unknown (e.g., Varies with device)
+    RELEASE_DATE = "release_date"  # YYYYMMDD
+    CACHE_COLUMNS = {
+        APP_NAME: cs.STRING,
+        PACKAGE: cs.STRING,
+        CATEGORY: cs.CATEGORY,
+        RATING: cs.STRING,
+        SIZE: cs.STRING,
+        RELEASE: cs.STRING,
+        LAST_UPDATED: cs.STRING,
+        FREE: 'b',
+        INSTALLS: 'q',
+        RATING_VALUE: 'd',
+        SIZE_BYTES: 'q',
+        RELEASE_DATE: 'i'
+    }
+
     def __init__(self,
                  top_num: int = 100,
                  min_release_date: str = None,
                  cut_for_cat: bool = True,
-                 free_only: bool = True) -> None:
+                 free_only: bool = True,
+                 num_procs: int = cfg.NUM_PARSE_PROCS,
+                 chunk_size: int = cfg.PARSE_CHUNK_SIZE,
+                 use_cache: bool = cfg.ENABLE_PARSE_CACHE,
+                 compact: bool = False) -> None:
         self._top_num = top_num
         self._min_release_date = min_release_date
         self._cut_for_cat = cut_for_cat
         self._free_only = free_only
+        self._num_procs = num_procs
+        self._chunk_size = chunk_size
+        self._use_cache = use_cache
+        self._compact = compact
 
     def parse_all(self, path: str) -> dict:
         path = os.path.abspath(path)
@@ -44,40 +126,57 @@ class AppDataParser:
         Parse all CSV files under the given directory
         '''
 
-        # Parse each CSV file in the given directory
-        print("Parsing ...")
-        data = {}
         csv_files = [os.path.join(path, f) \
                 for f in os.listdir(path) if f.endswith(".csv")]
-        for csv_file in csv_files:
-            partial_data = self.parse(csv_file, cut_top_num=False)
-            for cat in partial_data.keys():
-                if not cat in data:
-                    data[cat] = []
-                data[cat] = data[cat] + partial_data[cat]
-
-        # Sort each category
-        if self._cut_for_cat:
-            result = {}
-            for cat in data.keys():
-                sorted_data = \
-                        sorted(data[cat], key=lambda d: d[INSTALLS], reverse=True)
+        if self._use_cache:
+            return self._parse_cached(path, csv_files)
 
-                result[cat] = sorted_data[:self._top_num] \
-                        if len(sorted_data) > self._top_num else sorted_data
+        # Split each CSV file in the given directory into chunks of records
+        print("Parsing ...")
+        tasks = self._split_all(csv_files)
 
+        # Parse the chunks in parallel, keeping only the top apps of each
+        # category in each chunk
+        if self._num_procs > 1 and len(tasks) > 1:
+            with multiprocessing.Pool(min(self._num_procs, len(tasks))) as pool:
+                partial_data = pool.starmap(self._parse_chunk, tasks)
         else:
-            all_data = []
-            for cat in data.keys():
-                all_data += data[cat]
+            partial_data = [self._parse_chunk(*task) for task in tasks]
 
-            sorted_data = sorted(all_data,
-                                 key=lambda d: d[INSTALLS],
-                                 reverse=True)
-            result = sorted_data[:self._top_num] \
-                        if len(sorted_data) > self._top_num else sorted_data
+        # Order categories by their first appearance as in reading serially
+        first_pos = {}
+        for tops, first in partial_data:
+            for cat, pos in first.items():
+                if not cat in first_pos or pos < first_pos[cat]:
+                    first_pos[cat] = pos
+        cat_order = {cat: idx for idx, cat in
+                     enumerate(sorted(first_pos, key=lambda c: first_pos[c]))}
 
-        return result
+        # Merge the partial top apps. Ties are broken in reading order
+        # (stable sort), and by the order of categories when not cut for
+        # each category.
+        tops = {cat: TopN(self._top_num) for cat in cat_order.keys()}
+        top_all = TopN(self._top_num)
+        for partial_tops, first in partial_data:
+            for cat, entries in partial_tops.items():
+                if self._cut_for_cat:
+                    tops[cat].merge(entries)
+                    continue
+                for key, row in entries:
+                    top_all.push((key[0], -cat_order[cat]) + key[1:], row)
+
+        if self._cut_for_cat:
+            data = {cat: tops[cat].get() for cat in tops.keys()}
+            records = itertools.chain(*data.values())
+        else:
+            data = records = top_all.get()
+
+        # Share repeated values of the records from the workers again
+        if self._compact:
+            interned = {}
+            for record in records:
+                record._share(interned)
+        return data
 
     def parse(self, csv_file: str, cut_top_num: bool = True) -> dict:
         '''
@@ -87,65 +186,245 @@ class AppDataParser:
         if not os.path.exists(csv_file):
             sys.exit("Given CSV file doesn't exist: %s" % (csv_file))
 
+        tops = {}
+        for seq, row in enumerate(self._read_rows(csv_file)):
+            cat = row[CATEGORY]
+            if not cat in tops:
+                tops[cat] = TopN(self._top_num if cut_top_num else None)
+            tops[cat].push((row[INSTALLS], -seq), row)
+
+        return {cat: tops[cat].get() for cat in tops.keys()}
+
+    def _parse_cached(self, path: str, csv_files: list) -> dict:
+        '''
+        Rank the apps in the column store of the given directory, which is
+        (re)built with all valid apps when missing or out of date
+        '''
+        cache_path = os.path.join(path, cfg.PARSE_CACHE)
+        sources = ColumnStore.stamp(csv_files)
+        table = None
+        if os.path.exists(cache_path):
+            try:
+                table = ColumnStore(cache_path)
+                if table.sources != sources:
+                    table.close()
+                    table = None
+            except ColumnStoreError:
+                table = None
+
+        if table is None:
+            # Parse the chunks in parallel, and stream their records to the
+            # store in reading order
+            print("Building cache of %s ..." % (path))
+            parser = AppDataParser(free_only=False,
+                                   chunk_size=self._chunk_size)
+            tasks = [task[:4] for task in parser._split_all(csv_files)]
+            if self._num_procs > 1 and len(tasks) > 1:
+                with multiprocessing.Pool(min(self._num_procs,
+                                              len(tasks))) as pool:
+                    chunks = pool.imap(parser._parse_records_star, tasks)
+                    ColumnStore.write(cache_path, sources, CACHE_COLUMNS,
+                                      itertools.chain.from_iterable(chunks))
+            else:
+                chunks = (parser._parse_records(*task) for task in tasks)
+                ColumnStore.write(cache_path, sources, CACHE_COLUMNS,
+                                  itertools.chain.from_iterable(chunks))
+            table = ColumnStore(cache_path)
+
+        try:
+            return self._rank(table)
+        finally:
+            table.close()
+
+    def _rank(self, table: ColumnStore) -> dict:
+        '''
+        Filter and rank the apps in the given column store as parse_all()
+        '''
+        installs = table.column(INSTALLS)
+        categories = table.column(CATEGORY)
+        release_dates = table.column(RELEASE_DATE)
+
+        # Filter rows
+        rows = range(len(table))
+        if self._free_only:
+            rows = itertools.compress(rows, table.column(FREE))
+        if self._min_release_date:
+            max_date = int(self._min_release_date.replace('-', ''))
+            rows = (i for i in rows if release_dates[i] <= max_date)
+
+        # Group by category in the order of first appearance
+        groups = {}
+        for i in rows:
+            cat = categories[i]
+            if not cat in groups:
+                groups[cat] = []
+            groups[cat].append(i)
+
+        # Rank (heapq.nlargest is stable as sorted())
+        values = table.values(CATEGORY)
+        top_num = len(table) if self._top_num is None else self._top_num
+        interned = {}
+        if self._cut_for_cat:
+            return {values[cat]: [self._to_row(table, i, interned) for i in
+                                  heapq.nlargest(top_num, group,
+                                                 key=installs.__getitem__)]
+                    for cat, group in groups.items()}
+
+        top = heapq.nlargest(top_num, itertools.chain(*groups.values()),
+                             key=installs.__getitem__)
+        return [self._to_row(table, i, interned) for i in top]
+
+    def _to_record(self, row: dict) -> dict:
+        '''
+        Add the typed columns of the cache to the given row
+        '''
+        record = dict(row)
+        record[RATING_VALUE] = _to_float(row[RATING])
+        record[SIZE_BYTES] = _to_bytes(row[SIZE])
+        try:
+            record[RELEASE_DATE] = \
+                int(self._convert_date(row[RELEASE]).replace('-', ''))
+        except ValueError:
+            record[RELEASE_DATE] = 20501212
+        return record
+
+    def _to_row(self, table: ColumnStore, idx: int, interned: dict) -> dict:
+        if self._compact:
+            return AppRecord(table.get(APP_NAME, idx),
+                             table.get(PACKAGE, idx),
+                             table.get(CATEGORY, idx),
+                             table.get(RATING, idx),
+                             table.get(SIZE, idx),
+                             table.get(RELEASE, idx),
+                             table.get(LAST_UPDATED, idx),
+                             bool(table.get(FREE, idx)),
+                             table.get(INSTALLS, idx),
+                             table.get(RATING_VALUE, idx),
+                             table.get(SIZE_BYTES, idx),
+                             interned=interned)
+        return {
+            APP_NAME: table.get(APP_NAME, idx),
+            PACKAGE: table.get(PACKAGE, idx),
+            CATEGORY: table.get(CATEGORY, idx),
+            RATING: table.get(RATING, idx),
+            SIZE: table.get(SIZE, idx),
+            RELEASE: table.get(RELEASE, idx),
+            LAST_UPDATED: table.get(LAST_UPDATED, idx),
+            FREE: bool(table.get(FREE, idx)),
+            INSTALLS: table.get(INSTALLS, idx)
+        }
+
+    def _split_all(self, csv_files: list) -> list:
+        '''
+        Split the given CSV files into chunks of records, as arguments of
+        _parse_chunk()
+        '''
+        tasks = []
+        for file_idx, csv_file in enumerate(csv_files):
+            print(" - %s" % (csv_file))
+            fieldnames, ranges = _split_csv(csv_file, self._chunk_size)
+            for chunk_idx, (start, end) in enumerate(ranges):
+                tasks.append((csv_file, fieldnames, start, end,
+                              (file_idx, chunk_idx)))
+        return tasks
+
+    def _parse_records(self, csv_file: str, fieldnames: list, start: int,
+                       end: int) -> list:
+        '''
+        Records of the cache (see _to_record()) of the valid rows in the
+        given byte range of a CSV file
+        '''
+        with _read_chunk(csv_file, start, end) as text:
+            return [self._to_record(row) for row in self._filter_rows(
+                csv.DictReader(text, fieldnames=fieldnames))]
+
+    def _parse_records_star(self, task: tuple) -> list:
+        return self._parse_records(*task)
+
+    def _parse_chunk(self, csv_file: str, fieldnames: list, start: int,
+                     end: int, chunk_pos: tuple) -> tuple:
+        '''
+        Parse the records in the given byte range of a CSV file, and return
+        the top apps of each category as (key, row) pairs with the position
+        of the first app of each category. Keys are flat tuples of installs
+        and the negated position, to keep little per app.
+        '''
+        tops = {}
+        first = {}
+        with _read_chunk(csv_file, start, end) as text:
+            rows = self._filter_rows(csv.DictReader(text,
+                                                    fieldnames=fieldnames))
+            for row_idx, row in enumerate(rows):
+                cat = row[CATEGORY]
+                if not cat in tops:
+                    tops[cat] = TopN(self._top_num)
+                    first[cat] = chunk_pos + (row_idx, )
+                tops[cat].push((row[INSTALLS], -chunk_pos[0], -chunk_pos[1],
+                                -row_idx), row)
+
+        return {cat: tops[cat].entries() for cat in tops.keys()}, first
+
+    def _read_rows(self, csv_file: str):
+        '''
+        Yield valid rows of the given CSV file that pass the filters
+        '''
         # Parse the CSV file in Dictionary form
         print(" - %s" % (csv_file))
-        data = {}
         with open(csv_file, 'r') as file:
-            for row in csv.DictReader(file):
-                row_dict = dict(row)
+            yield from self._filter_rows(csv.DictReader(file))
 
-                # Skip invalid data
-                if not self._check_validity(row_dict):
-                    continue
-
-                # Prepare data to check
-                app_name = row_dict[APP_NAME]
-                pkg_name = row_dict[PACKAGE]
-                category = CAT[row_dict[CATEGORY]]
-                rating = row_dict[RATING]
-                rating_count = row_dict[RATING_COUNT]
-                size = row_dict[SIZE]
-                release = row_dict[RELEASE]
-                last_updated = row_dict[LAST_UPDATED]
-                free = eval(row_dict[FREE])
-                installs = int(row_dict[INSTALLS][:-1].replace(',', '')
-                               if row_dict[INSTALLS].endswith('+') else
-                               row_dict[INSTALLS].replace(',', ''))
-
-                # Check FREE or PAID
-                if self._free_only and not free:
-                    continue
+    def _filter_rows(self, reader: csv.DictReader):
+        '''
+        Yield valid rows that pass the filters
+        '''
+        interned = {}  # Values shared by the AppRecords of this reader
+        for row in reader:
+            row_dict = dict(row)
 
-                # Check release date
-                if self._min_release_date and \
-                        self._convert_date(release) > self._min_release_date:
-                    continue
+            # Skip invalid data
+            if not self._check_validity(row_dict):
+                continue
 
-                if not category in data:
-                    data[category] = []
+            # Prepare data to check
+            app_name = row_dict[APP_NAME]
+            pkg_name = row_dict[PACKAGE]
+            category = CAT[row_dict[CATEGORY]]
+            rating = row_dict[RATING]
+            rating_count = row_dict[RATING_COUNT]
+            size = row_dict[SIZE]
+            release = row_dict[RELEASE]
+            last_updated = row_dict[LAST_UPDATED]
+            free = eval(row_dict[FREE])
+            installs = int(row_dict[INSTALLS][:-1].replace(',', '')
+                           if row_dict[INSTALLS].endswith('+') else
+                           row_dict[INSTALLS].replace(',', ''))
 
-                data[category].append({
-                    APP_NAME: app_name,
-                    PACKAGE: pkg_name,
-                    CATEGORY: category,
-                    RATING: rating,
-                    SIZE: size,
-                    RELEASE: release,
-                    LAST_UPDATED: last_updated,
-                    FREE: free,
-                    INSTALLS: installs
-                })
+            # Check FREE or PAID
+            if self._free_only and not free:
+                continue
 
-        result = {}
-        for cat in data.keys():
-            sorted_data = \
-                    sorted(data[cat], key=lambda d: d[INSTALLS], reverse=True)
+            # Check release date
+            if self._min_release_date and \
+                    self._convert_date(release) > self._min_release_date:
+                continue
 
-            result[cat] = sorted_data[:self._top_num] \
-                    if len(sorted_data) > self._top_num and cut_top_num \
-                    else sorted_data
+            if self._compact:
+                yield AppRecord(app_name, pkg_name, category, rating, size,
+                                release, last_updated, free, installs,
+                                interned=interned)
+                continue
 
-        return result
+            yield {
+                APP_NAME: app_name,
+                PACKAGE: pkg_name,
+                CATEGORY: category,
+                RATING: rating,
+                SIZE: size,
+                RELEASE: release,
+                LAST_UPDATED: last_updated,
+                FREE: free,
+                INSTALLS: installs
+            }
 
     def _check_validity(self, row_dict: dict) -> bool:
         '''
@@ -193,4 +472,182 @@ class AppDataParser:
             # Return a date with large numbers
             converted = '2050-12-12'
 
-        return converted
\ No newline at end of file
+        return converted
+
+class AppRecord(collections.abc.Mapping):
+    '''
+    Compact row of AppDataParser (compact=True). Fields are kept in slots
+    instead of a dictionary per app, and values repeated across the apps of
+    a parse (category, rating, size, dates and installs) are shared through
+    the given 'interned' table. The rating and size are also kept parsed
+    (rating_value, size_bytes), while their strings are only for reading it
+    as the dictionary rows, e.g., record["App Id"].
+    '''
+    __slots__ = ('app_name', 'pkg_name', 'category', 'rating', 'size',
+                 'release', 'last_updated', 'free', 'installs',
+                 'rating_value', 'size_bytes')
+
+    def __init__(self, app_name: str, pkg_name: str, category: str,
+                 rating: str, size: str, release: str, last_updated: str,
+                 free: bool, installs: int, rating_value: float = None,
+                 size_bytes: int = None, interned: dict = None) -> None:
+        self.app_name = app_name
+        self.pkg_name = pkg_name
+        self.category = category
+        self.rating = rating
+        self.size = size
+        self.release = release
+        self.last_updated = last_updated
+        self.free = free
+        self.installs = installs
+        self.rating_value = _to_float(rating) if rating_value is None \
+            else rating_value
+        self.size_bytes = _to_bytes(size) if size_bytes is None \
+            else size_bytes
+        if interned is not None:
+            self._share(interned)
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, _RECORD_FIELDS[key])
+        except (KeyError, TypeError):
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(_RECORD_FIELDS)
+
+    def __len__(self) -> int:
+        return len(_RECORD_FIELDS)
+
+    def __reduce__(self):
+        return (AppRecord, tuple(getattr(self, f) for f in self.__slots__))
+
+    def __repr__(self) -> str:
+        return 'AppRecord(%r)' % (dict(self))
+
+    def to_dict(self) -> dict:
+        return dict(self)
+
+    def _share(self, interned: dict) -> None:
+        '''
+        Replace the repeated values with the ones in the given table
+        '''
+        for field in _SHARED_FIELDS:
+            value = getattr(self, field)
+            setattr(self, field, interned.setdefault(value, value))
+
+        # Keyed by their strings, as NaN is not equal to itself
+        self.rating_value = interned.setdefault(
+            (RATING_VALUE, self.rating), self.rating_value)
+        self.size_bytes = interned.setdefault(
+            (SIZE_BYTES, self.size), self.size_bytes)
+
+
+# Keys of the dictionary rows and their fields in AppRecord
+_RECORD_FIELDS = {
+    APP_NAME: 'app_name',
+    PACKAGE: 'pkg_name',
+    CATEGORY: 'category',
+    RATING: 'rating',
+    SIZE: 'size',
+    RELEASE: 'release',
+    LAST_UPDATED: 'last_updated',
+    FREE: 'free',
+    INSTALLS: 'installs'
+}
+
+# Fields of AppRecord whose values are shared
+_SHARED_FIELDS = ('category', 'rating', 'size', 'release', 'last_updated',
+                  'installs')
+
+
+def _split_csv(csv_file: str, chunk_size: int) -> tuple:
+    '''
+    Read the header of the given CSV file and split its records into byte
+    ranges of about 'chunk_size'. A newline ends a record only if an even
+    number of quotes precede it, so that quoted fields containing commas or
+    newlines are never split.
+    '''
+    size = os.path.getsize(csv_file)
+    ranges = []
+    with open(csv_file, 'rb') as file:
+        header = file.readline()
+        fieldnames = next(csv.reader(io.TextIOWrapper(io.BytesIO(header))))
+        start = offset = len(header)
+        target = start + chunk_size
+        in_quotes = False
+        while target < size:
+            block = file.read(SPLIT_BLOCK_SIZE)
+            if not block:
+                break
+
+            # Find the first record boundary after the target offset
+            idx = 0
+            while offset + len(block) > target:
+                newline = block.find(b'\n', max(idx, target - offset))
+                if newline < 0:
+                    break
+                in_quotes ^= bool(block.count(b'"', idx, newline) & 1)
+                idx = newline + 1
+                if not in_quotes:
+                    ranges.append((start, offset + idx))
+                    start = offset + idx
+                    target = start + chunk_size
+            in_quotes ^= bool(block.count(b'"', idx) & 1)
+            offset += len(block)
+
+    if start < size:
+        ranges.append((start, size))
+    return fieldnames, ranges
+
+
+class _RangeReader(io.RawIOBase):
+    '''
+    Raw stream of a byte range of a file
+    '''
+    def __init__(self, path: str, start: int, end: int) -> None:
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._left = end - start
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        if self._left <= 0:
+            return 0
+        num = self._file.readinto(memoryview(buf)[:self._left])
+        self._left -= num
+        return num
+
+    def close(self) -> None:
+        self._file.close()
+        super().close()
+
+
+def _read_chunk(csv_file: str, start: int, end: int) -> io.TextIOWrapper:
+    '''
+    Text of the given byte range of a CSV file, decoded as open() does so
+    that rows are the same as reading serially. It is read as it is parsed,
+    instead of holding the whole range in memory.
+    '''
+    return io.TextIOWrapper(io.BufferedReader(
+        _RangeReader(csv_file, start, end)))
+
+
+def _to_float(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+
+def _to_bytes(size: str) -> int:
+    '''
+    Convert the given size (e.g., 3.0M) to bytes
+    '''
+    units = {'k': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    try:
+        return int(float(size[:-1].replace(',', '')) * units[size[-1]])
+    except (ValueError, KeyError, IndexError):
+        return -1
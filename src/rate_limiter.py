@@ -0,0 +1,133 @@
+#!/usr/bin/env python3.7
+'''
+@author: Chang Min Park (cpark22@buffalo.edu)
+'''
+
+import threading
+import time
+
+# Local package
+import src.config as cfg
+from src.logger import Logger
+
+
+class TokenBucket:
+    '''
+    Token bucket refilled at 'rate' tokens per second, holding at most
+    'burst' tokens. The rate is adjusted by the owning RateLimiter (AIMD).
+    '''
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self) -> float:
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    '''
+    Rate limiter for the requests of a single account. Every request takes
+    a token from the account's bucket and from its endpoint's bucket. Rates
+    grow additively on success and shrink multiplicatively when the server
+    answers "busy" or HTTP 429 (AIMD), so that we run as fast as the server
+    tolerates.
+    '''
+    def __init__(self,
+                 account: str = None,
+                 rate: float = cfg.RATE_LIMIT_RPS,
+                 burst: float = cfg.RATE_LIMIT_BURST,
+                 endpoint_rate: dict = cfg.RATE_LIMIT_ENDPOINT_RPS) -> None:
+        self._account = account
+        self._burst = burst
+        self._endpoint_rate = endpoint_rate
+        self._bucket = TokenBucket(rate, burst)
+        self._max_rate = cfg.RATE_LIMIT_MAX_RPS
+        self._endpoints = {}
+        self._stats = {}
+        self._pause_until = 0
+        self._lock = threading.Lock()
+        self._logger = Logger.get_instance()
+
+    def acquire(self, endpoint: str) -> None:
+        '''
+        Block until a request to the given endpoint is allowed
+        '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                bucket = self._get_endpoint(endpoint)
+                self._bucket.refill(now)
+                bucket.refill(now)
+                wait = max(self._pause_until - now,
+                           self._bucket.wait_time(), bucket.wait_time())
+                if wait <= 0:
+                    self._bucket.tokens -= 1
+                    bucket.tokens -= 1
+                    self._stats[endpoint]['requests'] += 1
+                    return
+            time.sleep(wait)
+
+    def on_success(self, endpoint: str) -> None:
+        '''
+        Additive increase
+        '''
+        with self._lock:
+            for bucket in [self._bucket, self._get_endpoint(endpoint)]:
+                bucket.rate = min(self._max_rate,
+                                  bucket.rate + cfg.RATE_LIMIT_INCREASE)
+
+    def on_throttled(self, endpoint: str) -> None:
+        '''
+        Multiplicative decrease and a short cooldown for the account
+        '''
+        with self._lock:
+            for bucket in [self._bucket, self._get_endpoint(endpoint)]:
+                bucket.rate = max(cfg.RATE_LIMIT_MIN_RPS,
+                                  bucket.rate * cfg.RATE_LIMIT_DECREASE)
+                bucket.tokens = min(bucket.tokens, 0)
+            self._pause_until = time.monotonic() + cfg.RATE_LIMIT_COOLDOWN
+            self._stats[endpoint]['throttled'] += 1
+            rate = self._bucket.rate
+        self._logger.info(" - Server is busy (%s, %s). Rate limit: %.2f req/s"
+                          % (self._account, endpoint, rate))
+
+    def set_max_rate(self, rate: float) -> None:
+        '''
+        Cap the rates, e.g., to this node's share of the account's budget
+        when several nodes use the same account
+        '''
+        with self._lock:
+            self._max_rate = max(cfg.RATE_LIMIT_MIN_RPS, rate)
+            for bucket in [self._bucket] + list(self._endpoints.values()):
+                bucket.rate = min(bucket.rate, self._max_rate)
+
+    def get_rate(self, endpoint: str = None) -> float:
+        with self._lock:
+            if endpoint is None:
+                return self._bucket.rate
+            return self._get_endpoint(endpoint).rate
+
+    def get_stats(self) -> dict:
+        '''
+        Number of requests and throttled responses per endpoint
+        '''
+        with self._lock:
+            return {k: dict(v) for k, v in self._stats.items()}
+
+    # ----------------- #
+    #   Local Methods   #
+    # ----------------- #
+    def _get_endpoint(self, endpoint: str) -> TokenBucket:
+        # Should be called while holding the lock
+        if endpoint not in self._endpoints:
+            rate = self._endpoint_rate.get(endpoint, self._bucket.rate)
+            self._endpoints[endpoint] = TokenBucket(rate, self._burst)
+            self._stats[endpoint] = {'requests': 0, 'throttled': 0}
+        return self._endpoints[endpoint]
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3.7
+'''
+@author: Chang Min Park (cpark22@buffalo.edu)
+
+Read AndroidManifest.xml of a remote APK with a few HTTP Range requests:
+(1) the end of central directory record at the tail, (2) the central
+directory, and (3) only the local entry of the manifest. Without Range
+requests, LocalEntryReader finds the manifest while the APK is downloaded.
+'''
+
+import struct
+import zlib
+from typing import Callable, Tuple
+
+# Local package
+import src.axml as axml
+
+EOCD_SIG = b'PK\x05\x06'
+CD_SIG = b'PK\x01\x02'
+LOCAL_SIG = b'PK\x03\x04'
+EOCD_SIZE = 22
+CD_HEADER_SIZE = 46
+LOCAL_HEADER_SIZE = 30
+
+# The tail fetched first to find the EOCD record, which is usually the last
+# 22 bytes, and then the EOCD record with the largest possible zip comment
+TAIL_SIZE = 16 * (1 << 10)
+MAX_TAIL_SIZE = EOCD_SIZE + 0xFFFF
+
+# Extra bytes fetched with the manifest entry since the extra field of the
+# local header may be longer than the one in the central directory
+LOCAL_EXTRA_SLACK = 256
+
+STORED = 0
+DEFLATED = 8
+
+# General purpose flag of entries whose sizes follow the data
+DATA_DESCRIPTOR = 0x08
+
+
+class RemoteZipError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class RemoteZip:
+    '''
+    'fetch_range(start, length)' returns (data, total_size) for the given
+    byte range of the remote file. A negative 'start' means the last
+    '-start' bytes of the file (suffix range).
+    '''
+    def __init__(self, fetch_range: Callable[[int, int], Tuple[bytes, int]]):
+        self._fetch_range = fetch_range
+        self.total_size = None
+        self.bytes_fetched = 0
+        self.num_requests = 0
+
+    def read_manifest(self) -> dict:
+        '''
+        Fetch and decode AndroidManifest.xml (see axml.decode_manifest)
+        '''
+        return axml.decode_manifest(self.read_entry(axml.MANIFEST))
+
+    def read_entry(self, name: str) -> bytes:
+        '''
+        Fetch and decompress a single entry of the remote zip file
+        '''
+        # (1) End of central directory record
+        tail = self._fetch(-TAIL_SIZE, TAIL_SIZE)
+        eocd = tail.rfind(EOCD_SIG)
+        if eocd < 0 and len(tail) < self.total_size:
+            tail = self._fetch(-MAX_TAIL_SIZE, MAX_TAIL_SIZE)
+            eocd = tail.rfind(EOCD_SIG)
+        if eocd < 0 or len(tail) - eocd < EOCD_SIZE:
+            raise RemoteZipError("End of central directory is not found")
+        tail_start = self.total_size - len(tail)
+        cd_size, cd_offset = struct.unpack_from('<II', tail, eocd + 12)
+        if cd_offset == 0xFFFFFFFF or cd_size == 0xFFFFFFFF:
+            raise RemoteZipError("ZIP64 is not supported")
+
+        # (2) Central directory, which is usually already in the tail
+        if cd_offset >= tail_start:
+            cd = tail[cd_offset - tail_start:cd_offset - tail_start + cd_size]
+        else:
+            cd = self._fetch(cd_offset, cd_size)
+        entry = self._find_entry(cd, name)
+        if entry is None:
+            raise RemoteZipError("%s is not found" % (name))
+        method, comp_size, name_len, extra_len, local_offset = entry
+
+        # (3) Local file header and compressed data of the entry
+        length = LOCAL_HEADER_SIZE + name_len + extra_len + comp_size + \
+            LOCAL_EXTRA_SLACK
+        length = min(length, self.total_size - local_offset)
+        local = self._fetch(local_offset, length)
+        if local[:4] != LOCAL_SIG:
+            raise RemoteZipError("Invalid local file header")
+        name_len, extra_len = struct.unpack_from('<HH', local, 26)
+        data_start = LOCAL_HEADER_SIZE + name_len + extra_len
+        if data_start + comp_size > len(local):
+            local += self._fetch(local_offset + len(local),
+                                 data_start + comp_size - len(local))
+        return self._decompress(method, local[data_start:data_start +
+                                              comp_size])
+
+    # ----------------- #
+    #   Local Methods   #
+    # ----------------- #
+    def _fetch(self, start: int, length: int) -> bytes:
+        data, total_size = self._fetch_range(start, length)
+        self.num_requests += 1
+        self.bytes_fetched += len(data)
+        if total_size is not None:
+            self.total_size = total_size
+        elif self.total_size is None:
+            raise RemoteZipError("Total size of the remote file is unknown")
+        return data
+
+    @staticmethod
+    def _find_entry(cd: bytes, name: str) -> tuple:
+        '''
+        Find (method, compressed size, name length, extra length, local
+        header offset) of the given entry in the central directory
+        '''
+        encoded = name.encode('utf-8')
+        pos = 0
+        while pos + CD_HEADER_SIZE <= len(cd):
+            if cd[pos:pos + 4] != CD_SIG:
+                raise RemoteZipError("Invalid central directory")
+            method = struct.unpack_from('<H', cd, pos + 10)[0]
+            comp_size = struct.unpack_from('<I', cd, pos + 20)[0]
+            name_len, extra_len, comment_len = \
+                struct.unpack_from('<HHH', cd, pos + 28)
+            local_offset = struct.unpack_from('<I', cd, pos + 42)[0]
+            entry_name = cd[pos + CD_HEADER_SIZE:pos + CD_HEADER_SIZE +
+                            name_len]
+            if entry_name == encoded:
+                if comp_size == 0xFFFFFFFF or local_offset == 0xFFFFFFFF:
+                    raise RemoteZipError("ZIP64 is not supported")
+                return method, comp_size, name_len, extra_len, local_offset
+            pos += CD_HEADER_SIZE + name_len + extra_len + comment_len
+        return None
+
+    @staticmethod
+    def _decompress(method: int, data: bytes) -> bytes:
+        if method == STORED:
+            return data
+        elif method == DEFLATED:
+            return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+        raise RemoteZipError("Unsupported compression method: %d" % (method))
+
+
+class LocalEntryReader:
+    '''
+    Find an entry of a zip file while the file is downloaded, by walking
+    the local file headers from the start of the file. Other entries are
+    skipped without being kept. feed() returns the decompressed entry once
+    all of its bytes have arrived. 'failed' is set if the entry cannot be
+    found this way (e.g., an earlier entry has a data descriptor), and then
+    the whole file is needed.
+    '''
+    def __init__(self, name: str) -> None:
+        self._name = name.encode('utf-8')
+        self._buf = bytearray()
+        self._skip = 0
+        self.done = False
+        self.failed = False
+
+    def feed(self, data: bytes) -> bytes:
+        '''
+        Read the next bytes of the file. Returns the entry, or None if it
+        has not arrived (or cannot be found).
+        '''
+        if self.done:
+            return None
+        if self._skip:
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped
+            data = data[skipped:]
+        self._buf += data
+        try:
+            return self._read()
+        except (RemoteZipError, zlib.error):
+            self._fail()
+            return None
+
+    # ----------------- #
+    #   Local Methods   #
+    # ----------------- #
+    def _read(self) -> bytes:
+        buf = self._buf
+        while not self._skip and len(buf) >= LOCAL_HEADER_SIZE:
+            if buf[:4] != LOCAL_SIG:
+                # Central directory reached without the entry
+                raise RemoteZipError("%s is not found" % (self._name))
+            flags, method = struct.unpack_from('<HH', buf, 6)
+            comp_size = struct.unpack_from('<I', buf, 18)[0]
+            name_len, extra_len = struct.unpack_from('<HH', buf, 26)
+            data_start = LOCAL_HEADER_SIZE + name_len + extra_len
+            if len(buf) < data_start:
+                return None
+            if comp_size == 0xFFFFFFFF:
+                raise RemoteZipError("ZIP64 is not supported")
+            is_entry = buf[LOCAL_HEADER_SIZE:LOCAL_HEADER_SIZE + name_len] \
+                == self._name
+
+            if flags & DATA_DESCRIPTOR:
+                # The size is unknown, but a deflated entry ends by itself
+                if not is_entry or method != DEFLATED:
+                    raise RemoteZipError("Data descriptor is not supported")
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                entry = decompressor.decompress(bytes(buf[data_start:]))
+                if not decompressor.eof:
+                    return None
+                self._release()
+                return entry
+
+            if is_entry:
+                if len(buf) < data_start + comp_size:
+                    return None
+                entry = RemoteZip._decompress(
+                    method, bytes(buf[data_start:data_start + comp_size]))
+                self._release()
+                return entry
+
+            # Skip the other entry, including the bytes yet to arrive
+            end = data_start + comp_size
+            self._skip = max(0, end - len(buf))
+            del buf[:end]
+        return None
+
+    def _fail(self) -> None:
+        self.failed = True
+        self._release()
+
+    def _release(self) -> None:
+        self.done = True
+        self._buf = bytearray()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3.7
+'''
+@author: Chang Min Park (cpark22@buffalo.edu)
+'''
+
+import sqlite3
+import threading
+import time
+
+
+class SdkCache:
+    '''
+    On-disk cache of what a probe of (package, versionCode) revealed:
+    availability, minSdkVersion, targetSdkVersion and APK size. It lets the
+    version search skip network probes across runs and SDK targets. Results
+    of unavailable versions expire after 'unavailable_ttl' seconds (never if
+    None), except those cached since the cache was opened.
+    '''
+    def __init__(self, db_path: str, unavailable_ttl: float = None) -> None:
+        self._unavailable_ttl = unavailable_ttl
+        self._opened = time.time()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS probes (
+                    pkg_name TEXT NOT NULL,
+                    vc INTEGER NOT NULL,
+                    available INTEGER NOT NULL,
+                    min_sdk INTEGER NOT NULL DEFAULT -1,
+                    tgt_sdk INTEGER NOT NULL DEFAULT -1,
+                    size INTEGER NOT NULL DEFAULT -1,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (pkg_name, vc)
+                )''')
+
+    def get(self, pkg_name: str, vc: int) -> dict:
+        '''
+        Cached probe result of the given version, or None if never probed
+        (or expired)
+        '''
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT available, min_sdk, tgt_sdk, size FROM probes '
+                'WHERE pkg_name = ? AND vc = ? AND (available OR updated >= ?)',
+                (pkg_name, int(vc), self._get_expiry())).fetchone()
+        return None if row is None else self._to_entry(row)
+
+    def get_all(self, pkg_name: str) -> dict:
+        '''
+        All cached probe results of the given package, keyed by version code
+        '''
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT vc, available, min_sdk, tgt_sdk, size FROM probes '
+                'WHERE pkg_name = ? AND (available OR updated >= ?) '
+                'ORDER BY vc', (pkg_name, self._get_expiry())).fetchall()
+        return {row[0]: self._to_entry(row[1:]) for row in rows}
+
+    def put(self,
+            pkg_name: str,
+            vc: int,
+            available: bool,
+            min_sdk: int = -1,
+            tgt_sdk: int = -1,
+            size: int = -1) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (pkg_name, int(vc), int(available), min_sdk, tgt_sdk, size,
+                 time.time()))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # ----------------- #
+    #   Local Methods   #
+    # ----------------- #
+    def _get_expiry(self) -> float:
+        # Unavailable versions cached before this time are ignored
+        if self._unavailable_ttl is None:
+            return float('-inf')
+        return min(time.time() - self._unavailable_ttl, self._opened)
+
+    @staticmethod
+    def _to_entry(row: tuple) -> dict:
+        return {
+            'available': bool(row[0]),
+            'min_sdk': row[1],
+            'tgt_sdk': row[2],
+            'size': row[3]
+        }
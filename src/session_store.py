@@ -0,0 +1,80 @@
+#!/usr/bin/env python3.7
+'''
+@author: Chang Min Park (cpark22@buffalo.edu)
+'''
+
+import base64
+import hashlib
+import json
+import os
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+SALT_SIZE = 16
+KDF_ITERATIONS = 200000
+
+
+class SessionStore:
+    '''
+    Encrypted file storing the login session of a Google account (gsfId,
+    authSubToken, device config token and checkin consistency token), so
+    that later runs can skip the full login. The file is encrypted with a
+    key derived from the given secret, e.g., the account password.
+    '''
+    def __init__(self, path: str, secret: str) -> None:
+        self._path = path
+        self._secret = secret.encode('utf-8')
+
+    @staticmethod
+    def get_path(dir_path: str, account: str) -> str:
+        '''
+        Path of the session file of the given account in the directory
+        '''
+        name = hashlib.sha1(account.encode('utf-8')).hexdigest()
+        return os.path.join(dir_path, name)
+
+    def load(self) -> dict:
+        '''
+        Stored session, or None if there is none or it can't be decrypted
+        '''
+        if not os.path.exists(self._path):
+            return None
+        with open(self._path, 'rb') as f:
+            blob = f.read()
+        salt, token = blob[:SALT_SIZE], blob[SALT_SIZE:]
+        try:
+            data = self._fernet(salt).decrypt(token)
+            return json.loads(data.decode('utf-8'))
+        except (InvalidToken, ValueError):
+            return None
+
+    def save(self, session: dict) -> None:
+        salt = os.urandom(SALT_SIZE)
+        token = self._fernet(salt).encrypt(json.dumps(session).encode('utf-8'))
+        dir_path = os.path.dirname(self._path)
+        if dir_path: os.makedirs(dir_path, exist_ok=True)
+
+        # Readable only by the owner, and replaced atomically
+        tmp_path = self._path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(salt + token)
+        os.replace(tmp_path, self._path)
+
+    def clear(self) -> None:
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+    # ----------------- #
+    #   Local Methods   #
+    # ----------------- #
+    def _fernet(self, salt: bytes) -> Fernet:
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(),
+                         length=32,
+                         salt=salt,
+                         iterations=KDF_ITERATIONS,
+                         backend=default_backend())
+        return Fernet(base64.urlsafe_b64encode(kdf.derive(self._secret)))
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3.7
+'''
+@author: Chang Min Park (cpark22@buffalo.edu)
+
+Strategies to choose the version codes to probe when searching for a
+version of an app accepted by a target SDK version. Versions are assumed to
+be ordered by targetSdkVersion, so each probe narrows down the range of
+version codes left to search.
+'''
+
+import bisect
+import math
+from abc import ABC, abstractmethod
+
+import src.config as cfg
+
+# Search Strategies
+BISECT = 'bisect'
+GALLOP = 'gallop'
+INTERPOLATE = 'interpolate'
+KARY = 'kary'
+
+
+class VersionLattice:
+    '''
+    Pattern of the valid version codes of an app, learned from version
+    codes known to exist, so that codes which cannot exist aren't probed:
+    a stride and residue, the largest power of 10 dividing the differences
+    between the codes, e.g., 100 if the last two digits are a fixed ABI or
+    density suffix. n codes share a stride s by chance with a probability of
+    about 1 / s^(n - 1), so a stride is taken only if
+    s^(n - 1) >= 'confidence'. Nothing is assumed until 'min_samples' codes
+    are known. Strategies fall back to codes off the pattern once no code
+    fitting it is left, e.g., for old versions of another scheme.
+    '''
+    def __init__(self,
+                 min_samples: int = cfg.LATTICE_MIN_SAMPLES,
+                 confidence: int = cfg.LATTICE_CONFIDENCE) -> None:
+        self._min_samples = min_samples
+        self._confidence = confidence
+        self._codes = set()
+        self.stride, self.residue = 1, 0
+
+    def add(self, vc: int) -> None:
+        '''
+        Learn from a version code that exists
+        '''
+        if vc in self._codes:
+            return
+        self._codes.add(vc)
+        if len(self._codes) < self._min_samples:
+            return
+        codes = sorted(self._codes)
+        stride = 0
+        for code in codes[1:]:
+            stride = math.gcd(stride, code - codes[0])
+        # Probes of a search are no random codes (e.g., halves of the latest
+        # version code), so only decimal suffixes are learned
+        decimal = 1
+        while stride and stride % (decimal * 10) == 0:
+            decimal *= 10
+        if decimal > 1 and decimal ** (len(codes) - 1) >= self._confidence:
+            self.stride, self.residue = decimal, codes[0] % decimal
+        else:
+            self.stride, self.residue = 1, 0
+
+    def fits(self, vc: int) -> bool:
+        return vc % self.stride == self.residue
+
+    def snap(self, vc: int, l_vc: int, r_vc: int) -> int:
+        '''
+        The version code nearest to 'vc' (the higher on a tie) that fits
+        the pattern between 'l_vc' and 'r_vc' (exclusive), or None if none
+        '''
+        low, high = l_vc + 1, r_vc - 1
+        low += (self.residue - low) % self.stride
+        high -= (high - self.residue) % self.stride
+        if low > high:
+            return None
+        vc = min(max(vc, low), high)
+        below = vc - (vc - self.residue) % self.stride
+        above = below if below == vc else below + self.stride
+        candidates = [c for c in [below, above] if low <= c <= high]
+        return min(candidates, key=lambda c: (abs(c - vc), -c))
+
+
+class SearchStrategy(ABC):
+    '''
+    - next_vc(): version code to probe next, or None if the search is over
+    - next_vcs(k): up to k version codes to probe at once ([] if over)
+    - update(vc, tgt_sdk): targetSdkVersion of a probed version code that
+      was not accepted (None if the version is unavailable)
+    - contains(vc): whether the version code is still worth probing
+    - get_bounds(): state of the search (see job_ledger.BOUNDS) to resume it
+    'unavailable' tells whether a search that is over ended at an
+    unavailable version code rather than a gap between SDK versions.
+    '''
+    def __init__(self, sdk_version: int, latest_vc: int,
+                 bounds: dict = None, observed: dict = None,
+                 lattice: VersionLattice = None) -> None:
+        # 'observed' maps version codes probed so far, e.g., for other SDK
+        # versions, to their targetSdkVersion (None if unavailable)
+        # 'lattice' is the pattern of valid version codes, which the version
+        # codes to probe are snapped to while any code in range fits it
+        self.sdk_version = sdk_version
+        self.latest_vc = latest_vc
+        self.observed = observed if observed is not None else {}
+        self.lattice = lattice
+        self.unavailable = False
+
+    @abstractmethod
+    def next_vc(self) -> int:
+        pass
+
+    def next_vcs(self, k: int) -> list:
+        vc = self.next_vc()
+        return [] if vc is None else [vc]
+
+    @abstractmethod
+    def update(self, vc: int, tgt_sdk: int) -> None:
+        pass
+
+    def contains(self, vc: int) -> bool:
+        return True
+
+    @abstractmethod
+    def get_bounds(self) -> dict:
+        pass
+
+
+class Bisect(SearchStrategy):
+    '''
+    Binary search between 0 and the latest version code. An unavailable
+    version code is searched above, like an older SDK version.
+    '''
+    def __init__(self, sdk_version: int, latest_vc: int,
+                 bounds: dict = None, observed: dict = None,
+                 lattice: VersionLattice = None) -> None:
+        super().__init__(sdk_version, latest_vc, bounds, observed, lattice)
+        self.l_vc, self.r_vc, self.prev_vc = 0, latest_vc, 0
+        self.l_vc_not_found = None
+        # Version codes snapped to the lattice, each probed once at most
+        self._snapped = set()
+        if bounds:
+            self.l_vc, self.r_vc = bounds['l_vc'], bounds['r_vc']
+            self.l_vc_not_found = bounds['l_vc_not_found']
+            self.prev_vc = bounds['prev_vc']
+
+    def next_vc(self) -> int:
+        if self.l_vc_not_found:
+            vc = math.ceil((self.l_vc_not_found + self.r_vc) / 2)
+        else:
+            vc = math.ceil((self.l_vc + self.r_vc) / 2)
+        if self.lattice:
+            snapped = self.lattice.snap(vc, self.l_vc_not_found or self.l_vc,
+                                        self.r_vc + 1)
+            if snapped is not None and snapped not in self._snapped:
+                self._snapped.add(snapped)
+                vc = snapped
+        if vc == self.prev_vc:
+            self.unavailable = vc == self.l_vc_not_found
+            return None
+        self.prev_vc = vc
+        return vc
+
+    def update(self, vc: int, tgt_sdk: int) -> None:
+        if tgt_sdk is None:
+            self.l_vc = vc
+            self.l_vc_not_found = self.l_vc
+        elif tgt_sdk > self.sdk_version:
+            if self.l_vc_not_found:
+                self.l_vc = math.ceil((vc + self.l_vc_not_found) / 2)
+            self.r_vc = vc
+        elif tgt_sdk < self.sdk_version:
+            self.l_vc = vc
+            self.l_vc_not_found = None
+
+    def get_bounds(self) -> dict:
+        return {
+            'l_vc': self.l_vc,
+            'r_vc': self.r_vc,
+            'l_vc_not_found': self.l_vc_not_found,
+            'prev_vc': self.prev_vc
+        }
+
+
+class Bracket(SearchStrategy):
+    '''
+    Search between 'l_vc' (a version of an older SDK version, or 0) and
+    'r_vc' (a version of a newer SDK version, or past the latest), both
+    exclusive. Like Bisect, an unavailable version code becomes 'l_vc',
+    unless 'keep_unavailable': then the range is kept, and the widest gap
+    between the unavailable version codes in it ('holes') is split instead,
+    until as many holes as bisecting the range takes are found. Subclasses
+    choose the version code to probe in between.
+    '''
+    keep_unavailable = False
+
+    def __init__(self, sdk_version: int, latest_vc: int,
+                 bounds: dict = None, observed: dict = None,
+                 lattice: VersionLattice = None) -> None:
+        super().__init__(sdk_version, latest_vc, bounds, observed, lattice)
+        self.l_vc, self.r_vc, self.prev_vc = 0, latest_vc + 1, 0
+        self.l_vc_not_found = None
+        if bounds:
+            self.l_vc, self.r_vc = bounds['l_vc'], bounds['r_vc']
+            self.l_vc_not_found = bounds['l_vc_not_found']
+            self.prev_vc = bounds['prev_vc']
+        self._holes = []
+        self._misses = 0
+        self._max_misses = (self.r_vc - self.l_vc).bit_length()
+
+    def next_vc(self) -> int:
+        l_vc, r_vc = self._get_gap()
+        if r_vc - l_vc <= 1 or self._misses >= self._max_misses:
+            self.unavailable = self.l_vc_not_found is not None or \
+                bool(self._holes)
+            return None
+        vc = min(max(self._choose(), self.l_vc + 1), self.r_vc - 1)
+        if vc in self._holes:
+            vc = (l_vc + r_vc) // 2
+        if self.lattice:
+            snapped = self.lattice.snap(vc, *self._get_gap(vc))
+            vc = vc if snapped is None else snapped
+        self.prev_vc = vc
+        return vc
+
+    def update(self, vc: int, tgt_sdk: int) -> None:
+        if vc <= self.l_vc or vc >= self.r_vc:
+            return
+        if tgt_sdk is None:
+            if self.keep_unavailable:
+                if vc not in self._holes:
+                    bisect.insort(self._holes, vc)
+                    self._misses += 1
+                return
+            self.l_vc = vc
+            self.l_vc_not_found = vc
+        elif tgt_sdk > self.sdk_version:
+            self.r_vc = vc
+        else:
+            self.l_vc = vc
+            self.l_vc_not_found = None
+        self._holes = [h for h in self._holes if self.l_vc < h < self.r_vc]
+
+    def contains(self, vc: int) -> bool:
+        return self.l_vc < vc < self.r_vc
+
+    def get_bounds(self) -> dict:
+        return {
+            'l_vc': self.l_vc,
+            'r_vc': self.r_vc,
+            'l_vc_not_found': self.l_vc_not_found,
+            'prev_vc': self.prev_vc
+        }
+
+    # ----------------- #
+    #   Local Methods   #
+    # ----------------- #
+    def _choose(self) -> int:
+        l_vc, r_vc = self._get_gap()
+        return (l_vc + r_vc) // 2
+
+    def _get_gap(self, vc: int = None) -> tuple:
+        # Ends of the widest gap between holes in the range (the highest on a
+        # tie, as newer versions are more often available), or of the gap
+        # around the given version code
+        ends = [self.l_vc] + self._holes + [self.r_vc]
+        if vc is not None:
+            idx = bisect.bisect_left(ends, vc)
+            return ends[idx - 1], ends[idx]
+        return max(zip(ends, ends[1:]), key=lambda g: (g[1] - g[0], g[0]))
+
+
+class Gallop(Bracket):
+    '''
+    Probe down from the latest version with doubling steps (latest,
+    latest - 1, latest - 3, latest - 7, ...) until a version of an older SDK
+    version is found, and then bisect. The number of probes grows with the
+    log of the distance from the latest version rather than of the latest
+    version code. Unavailable version codes are kept (see Bracket). Once a
+    version of an older SDK version is found, the range left gets its own
+    number of holes to give up at. A resumed search gallops again from
+    'r_vc'.
+    '''
+    keep_unavailable = True
+
+    def __init__(self, sdk_version: int, latest_vc: int,
+                 bounds: dict = None, observed: dict = None,
+                 lattice: VersionLattice = None) -> None:
+        super().__init__(sdk_version, latest_vc, bounds, observed, lattice)
+        self._step = 1
+        self._galloping = self.l_vc == 0
+
+    def update(self, vc: int, tgt_sdk: int) -> None:
+        super().update(vc, tgt_sdk)
+        if not self._galloping:
+            return
+        self._step *= 2
+        if tgt_sdk is not None and tgt_sdk <= self.sdk_version:
+            self._galloping = False
+            self._max_misses = self._misses + \
+                (self.r_vc - self.l_vc).bit_length()
+
+    # ----------------- #
+    #   Local Methods   #
+    # ----------------- #
+    def _choose(self) -> int:
+        if self._galloping:
+            vc = self.r_vc - self._step
+            if vc > self.l_vc:
+                return vc
+            self._galloping = False
+        return super()._choose()
+
+
+class Interpolate(Bracket):
+    '''
+    Estimate the version code where targetSdkVersion reaches the SDK
+    version by interpolating between the nearest versions observed below
+    and above it, including probes for other SDK versions. The latest
+    version is probed first. Unavailable version codes are kept (see
+    Bracket), and an estimate that didn't halve the range is followed by a
+    bisection.
+    '''
+    keep_unavailable = True
+
+    def __init__(self, sdk_version: int, latest_vc: int,
+                 bounds: dict = None, observed: dict = None,
+                 lattice: VersionLattice = None) -> None:
+        super().__init__(sdk_version, latest_vc, bounds, observed, lattice)
+        self._width = self.r_vc - self.l_vc
+        self._interpolated = False
+
+    def update(self, vc: int, tgt_sdk: int) -> None:
+        super().update(vc, tgt_sdk)
+        self.observed.setdefault(vc, tgt_sdk)
+
+    # ----------------- #
+    #   Local Methods   #
+    # ----------------- #
+    def _choose(self) -> int:
+        if self.r_vc > self.latest_vc and self.latest_vc > self.l_vc:
+            return self.latest_vc
+
+        # Bisect unless the last estimate halved the range
+        width, self._width = self._width, self.r_vc - self.l_vc
+        interpolated, self._interpolated = self._interpolated, False
+        if interpolated and self._width > width / 2:
+            return super()._choose()
+
+        l_vc, l_tgt = self._get_nearest(self.l_vc, below=True)
+        r_vc, r_tgt = self._get_nearest(self.r_vc, below=False)
+        if r_tgt is None or r_tgt <= l_tgt:
+            return super()._choose()
+        ratio = (self.sdk_version - l_tgt + 0.5) / (r_tgt - l_tgt)
+        self._interpolated = True
+        return l_vc + int(round(ratio * (r_vc - l_vc)))
+
+    def _get_nearest(self, vc: int, below: bool) -> tuple:
+        # (version code, targetSdkVersion) of the nearest available version
+        # observed at or beyond the given end of the range. Below the range,
+        # version code 0 stands for SDK version 1.
+        if below:
+            known = [v for v, t in self.observed.items()
+                     if t is not None and v <= vc]
+            return (max(known), self.observed[max(known)]) if known \
+                else (0, 1)
+        known = [v for v, t in self.observed.items()
+                 if t is not None and v >= vc]
+        return (min(known), self.observed[min(known)]) if known \
+            else (vc, None)
+
+
+class Kary(Bracket):
+    '''
+    Split the range evenly with k version codes probed at once, so that a
+    round of concurrent probes shrinks the range k + 1 times rather than
+    halving it. Probes of a round are applied in version-code order, and
+    those left out of the range can be cancelled (see contains()).
+    '''
+    def next_vcs(self, k: int) -> list:
+        if self.r_vc - self.l_vc <= 1:
+            self.unavailable = self.l_vc_not_found is not None
+            return []
+        width = self.r_vc - self.l_vc
+        vcs = [self.l_vc + max(1, width * i // (k + 1))
+               for i in range(1, max(1, k) + 1)]
+        if self.lattice:
+            snapped = [self.lattice.snap(vc, self.l_vc, self.r_vc)
+                       for vc in vcs]
+            vcs = [vc if s is None else s for vc, s in zip(vcs, snapped)]
+        vcs = sorted(set([vc for vc in vcs if self.contains(vc)]))
+        self.prev_vc = vcs[-1]
+        return vcs
+
+
+STRATEGIES = {
+    BISECT: Bisect,
+    GALLOP: Gallop,
+    INTERPOLATE: Interpolate,
+    KARY: Kary
+}
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3.7
+'''
+@author: Chang Min Park (cpark22@buffalo.edu)
+'''
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import src.config as cfg
+
+# Task States
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WorkQueue:
+    '''
+    Queue of packages shared by several nodes through a SQLite database,
+    e.g., on NFS. A node claims a package with a lease that it keeps
+    renewing with heartbeat(). If a node dies, its leases expire and other
+    nodes claim the packages again, up to 'max_attempts' times. Nodes also
+    register each of their accounts, so that an account's rate can be split
+    among the nodes using it.
+    '''
+    def __init__(self,
+                 db_path: str,
+                 node_id: str = None,
+                 accounts: list = None,
+                 lease_time: float = cfg.LEASE_TIME,
+                 max_attempts: int = cfg.MAX_ATTEMPTS) -> None:
+        self.node_id = node_id if node_id else \
+            '%s:%d' % (socket.gethostname(), os.getpid())
+        self._accounts = sorted(set(accounts)) if accounts else []
+        self._lease_time = lease_time
+        self._max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+        # Transactions are managed explicitly (BEGIN IMMEDIATE) so that only
+        # one node claims a package at a time
+        self._conn = sqlite3.connect(db_path, timeout=60,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        with self._lock:
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS tasks (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    pkg_name TEXT NOT NULL,
+                    cat TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    owner TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    updated REAL NOT NULL,
+                    UNIQUE (pkg_name, cat)
+                )''')
+            # One lease row per account of each node
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS accounts (
+                    node_id TEXT NOT NULL,
+                    account TEXT NOT NULL,
+                    heartbeat REAL NOT NULL,
+                    PRIMARY KEY (node_id, account)
+                )''')
+
+    def enqueue(self, pkg_list: list) -> None:
+        '''
+        Add the given (package name, category) tuples unless already added,
+        so that every node can enqueue the same list
+        '''
+        now = time.time()
+        with self._lock:
+            self._begin()
+            try:
+                self._conn.executemany(
+                    'INSERT OR IGNORE INTO tasks (pkg_name, cat, state, '
+                    'updated) VALUES (?, ?, ?, ?)',
+                    [(pkg_name, cat, PENDING, now)
+                     for pkg_name, cat in pkg_list])
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def claim(self) -> tuple:
+        '''
+        Claim the next pending package, or a package whose lease expired.
+        Returns (package name, category), or None if there is none now.
+        '''
+        now = time.time()
+        with self._lock:
+            self._begin()
+            try:
+                # Give up packages whose leases expired too many times
+                self._conn.execute(
+                    'UPDATE tasks SET state = ?, result = ?, updated = ? '
+                    'WHERE state = ? AND lease_until < ? AND attempts >= ?',
+                    (FAILED, 'Lease expired', now, CLAIMED, now,
+                     self._max_attempts))
+                row = self._conn.execute(
+                    'SELECT seq, pkg_name, cat FROM tasks WHERE state = ? '
+                    'OR (state = ? AND lease_until < ?) ORDER BY seq LIMIT 1',
+                    (PENDING, CLAIMED, now)).fetchone()
+                if row:
+                    self._conn.execute(
+                        'UPDATE tasks SET state = ?, owner = ?, '
+                        'lease_until = ?, attempts = attempts + 1, '
+                        'updated = ? WHERE seq = ?',
+                        (CLAIMED, self.node_id, now + self._lease_time, now,
+                         row[0]))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return None if row is None else (row[1], row[2])
+
+    def complete(self, pkg_name: str, cat: str, result: str = None) -> bool:
+        '''
+        Mark the given package done with its result. Returns False if the
+        lease was lost to another node.
+        '''
+        with self._lock:
+            cursor = self._conn.execute(
+                'UPDATE tasks SET state = ?, lease_until = NULL, result = ?, '
+                'updated = ? WHERE pkg_name = ? AND cat = ? AND owner = ? '
+                'AND state = ?', (DONE, result, time.time(), pkg_name, cat,
+                                  self.node_id, CLAIMED))
+        return cursor.rowcount > 0
+
+    def fail(self, pkg_name: str, cat: str, reason: str) -> bool:
+        '''
+        Release the given package to be claimed again, or mark it failed if
+        it was attempted 'max_attempts' times
+        '''
+        with self._lock:
+            cursor = self._conn.execute(
+                'UPDATE tasks SET state = CASE WHEN attempts >= ? THEN ? '
+                'ELSE ? END, owner = NULL, lease_until = NULL, result = ?, '
+                'updated = ? WHERE pkg_name = ? AND cat = ? AND owner = ? '
+                'AND state = ?',
+                (self._max_attempts, FAILED, PENDING, reason, time.time(),
+                 pkg_name, cat, self.node_id, CLAIMED))
+        return cursor.rowcount > 0
+
+    def heartbeat(self) -> dict:
+        '''
+        Renew the leases of this node, and return the number of live nodes
+        using each of its accounts (including this node), keyed by account
+        '''
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'UPDATE tasks SET lease_until = ? WHERE owner = ? '
+                'AND state = ?', (now + self._lease_time, self.node_id,
+                                  CLAIMED))
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO accounts VALUES (?, ?, ?)',
+                [(self.node_id, account, now) for account in self._accounts])
+            rows = self._conn.execute(
+                'SELECT account, COUNT(*) FROM accounts WHERE heartbeat >= ? '
+                'GROUP BY account', (now - self._lease_time, )).fetchall()
+        num_nodes = dict(rows)
+        return {account: max(1, num_nodes.get(account, 0))
+                for account in self._accounts}
+
+    def leave(self) -> None:
+        '''
+        Unregister this node, and release the packages it still holds
+        '''
+        with self._lock:
+            self._conn.execute('DELETE FROM accounts WHERE node_id = ?',
+                               (self.node_id, ))
+            self._conn.execute(
+                'UPDATE tasks SET state = ?, owner = NULL, lease_until = NULL '
+                'WHERE owner = ? AND state = ?',
+                (PENDING, self.node_id, CLAIMED))
+
+    def is_finished(self) -> bool:
+        '''
+        Whether no package is pending or claimed by any node
+        '''
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT COUNT(*) FROM tasks WHERE state IN (?, ?)',
+                (PENDING, CLAIMED)).fetchone()
+        return row[0] == 0
+
+    def get_summary(self) -> dict:
+        '''
+        Number of packages in each state, and number of packages done by
+        each node
+        '''
+        with self._lock:
+            states = self._conn.execute(
+                'SELECT state, COUNT(*) FROM tasks GROUP BY state').fetchall()
+            nodes = self._conn.execute(
+                'SELECT owner, COUNT(*) FROM tasks WHERE state = ? '
+                'GROUP BY owner', (DONE, )).fetchall()
+        return {'states': dict(states), 'nodes': dict(nodes)}
+
+    def get_results(self) -> list:
+        '''
+        (package name, category, state, node, result) of all packages
+        '''
+        with self._lock:
+            return self._conn.execute(
+                'SELECT pkg_name, cat, state, owner, result FROM tasks '
+                'ORDER BY seq').fetchall()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # ----------------- #
+    #   Local Methods   #
+    # ----------------- #
+    def _begin(self) -> None:
+        # Take the write lock of the database up front
+        self._conn.execute('BEGIN IMMEDIATE')